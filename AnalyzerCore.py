@@ -0,0 +1,791 @@
+import functools
+import os
+import queue
+import threading
+from collections import deque
+from time import perf_counter
+
+import numpy as np
+
+import ExtractBpmPatterns
+import Metrics
+from PatternMatcher import PatternMatcher
+
+FRAME_RATE = int(11025)
+
+MIN_BPM = 100.0
+MAX_BPM = 160.0
+
+# filter and scan only newly arrived audio instead of the whole buffer
+STREAMING_ANALYZER = False
+
+# "window" takes the loudest sample of every half second, "onsets" every
+# spectral-flux onset (window search only; the streaming analyzer always uses
+# the half-second windows)
+ONSET_DETECTOR = "window"
+
+# "voting" matches beat patterns (BpmAnalyzer), "autocorrelation" combs the
+# FFT autocorrelation of the onset envelope (AutocorrelationEngine)
+TEMPO_ENGINE = "voting"
+
+# match the tempo on an envelope decimated by DECIMATION first and refine
+# only around the winner at full rate (window search only)
+MULTI_RATE = False
+DECIMATION = 64
+
+# results below this confidence are not passed to the tempo tracker
+MIN_CONFIDENCE = 0.0
+
+# tempo tracker: median of the last TRACKER_WINDOW results; results further
+# than TRACKER_GATE BPM away only take over after TRACKER_CHANGE_COUNT passes
+# that agree with each other (TRACKER_OCTAVE_COUNT for 1/2, 2/3, 3/2 and 2
+# times the current tempo, the usual octave errors)
+TRACKER_WINDOW = 5
+TRACKER_GATE = 1.0
+TRACKER_CHANGE_COUNT = 2
+TRACKER_OCTAVE_COUNT = 4
+
+# seconds between analysis passes; audio that arrives while a pass is running
+# is coalesced into the next one
+ANALYSIS_HOP_SECONDS = 0.5
+
+# directory of a memory-mapped pattern cache shared by all analyzer processes
+PATTERN_CACHE = os.environ.get("BPM_PATTERN_CACHE")
+
+BPM_PATTERN = ExtractBpmPatterns.BpmPattern.coarse(FRAME_RATE, MIN_BPM, MAX_BPM)
+BPM_PATTERN_FINE = ExtractBpmPatterns.BpmPattern.fine(FRAME_RATE, MIN_BPM, MAX_BPM)
+# fine rows searched on either side of the coarse result (+/- 1 BPM)
+FINE_WINDOW = int(round(1 / BPM_PATTERN_FINE.step))
+BPM_PATTERN_DECIMATED = ExtractBpmPatterns.BpmPattern.decimated(FRAME_RATE, DECIMATION, MIN_BPM, MAX_BPM)
+# envelope frames a beat may miss its pattern entry by
+DECIMATED_TOLERANCE = 2
+
+
+def use_pattern_cache(directory: str) -> None:
+    # also exported to the environment, so worker processes pick it up
+    global PATTERN_CACHE
+    PATTERN_CACHE = os.environ["BPM_PATTERN_CACHE"] = directory
+    BpmAnalyzer.coarse_pattern_matcher.cache_clear()
+    BpmAnalyzer.decimated_pattern_matcher.cache_clear()
+
+
+def user_cache_directory() -> str:
+    # per-user, so no other account can plant or swap the cached patterns
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    directory = os.path.join(base, "bpm_analyzer", "patterns")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if hasattr(os, "getuid") and os.stat(directory).st_uid != os.getuid():
+        raise PermissionError(f"pattern cache {directory} is not owned by this user")
+    return directory
+
+
+def shared_pattern_cache() -> None:
+    # worker processes memory-map one pattern cache instead of building their
+    # own; BPM_PATTERN_CACHE overrides the per-user default
+    if not PATTERN_CACHE:
+        use_pattern_cache(user_cache_directory())
+    BpmAnalyzer.coarse_pattern_matcher()  # builds the cache before the workers start
+
+
+class TempoTracker:
+    # Confidence weighted median of the recent results with outlier gating.
+    # Results outside the gate are held back; once enough of them agree with
+    # each other the tracker jumps to them at once (change point) instead of
+    # sliding over several passes.
+    def __init__(
+        self,
+        window=TRACKER_WINDOW,
+        gate=TRACKER_GATE,
+        change_count=TRACKER_CHANGE_COUNT,
+        octave_count=TRACKER_OCTAVE_COUNT,
+    ):
+        self.window = window
+        self.gate = gate
+        self.change_count = change_count
+        self.octave_count = octave_count
+        self.reset()
+
+    def reset(self) -> None:
+        self.history = deque(maxlen=self.window)  # (bpm, weight)
+        self.outliers = []
+        self.tempo = None
+
+    def update(self, bpm: float, weight=1.0) -> float:
+        if self.tempo is None or abs(bpm - self.tempo) <= self.gate:
+            self.history.append((bpm, weight))
+            self.outliers.clear()
+        else:
+            self.outliers = [(other, w) for other, w in self.outliers if abs(other - bpm) <= self.gate]
+            self.outliers.append((bpm, weight))
+            if len(self.outliers) >= self.confirmations(bpm):
+                self.history.clear()
+                self.history.extend(self.outliers)
+                self.outliers.clear()
+        self.tempo = TempoTracker.weighted_median(self.history)
+        return self.tempo
+
+    def confirmations(self, bpm: float) -> int:
+        for ratio in (0.5, 2 / 3, 1.5, 2.0):
+            if abs(bpm - self.tempo * ratio) <= self.gate:
+                return self.octave_count
+        return self.change_count
+
+    def weighted_median(history: deque) -> float:
+        values = sorted(history)
+        half = sum(weight for _, weight in values) / 2
+        total = 0.0
+        for bpm, weight in values:
+            total += weight
+            if total >= half:
+                return bpm
+
+    def replay(estimates, **settings) -> list:
+        # tracked tempo after each (bpm, weight) estimate, None for rejected passes
+        tempo_tracker = TempoTracker(**settings)
+        return [
+            tempo_tracker.tempo if bpm is None else tempo_tracker.update(bpm, weight) for bpm, weight in estimates
+        ]
+
+
+class BpmStorage:
+    def __init__(self):
+        self._float = 120.00  # default
+        self._str = "***.**"  # default
+        self.tempo_tracker = TempoTracker()
+
+
+class BpmResult:
+    # What one analysis pass found. It is falsy when the pass was rejected;
+    # rejected then says why and bpm is None.
+    __slots__ = ("bpm", "bpm_str", "beat_phase", "confidence", "candidates", "alternatives", "rejected")
+
+    def __init__(
+        self, bpm=None, bpm_str=None, beat_phase=None, confidence=0.0, candidates=(), alternatives=None, rejected=None
+    ):
+        self.bpm = bpm
+        self.bpm_str = bpm_str
+        self.beat_phase = beat_phase
+        self.confidence = confidence  # share of the beat events on the winning grid, 0 to 1
+        self.candidates = candidates  # ((bpm, votes), ...) of the coarse pass, best first
+        self.alternatives = alternatives or {}  # {"half": (bpm, votes), "double": ...}, votes None out of range
+        self.rejected = rejected
+
+    def __bool__(self) -> bool:
+        return self.rejected is None
+
+    def __repr__(self) -> str:
+        if self.rejected:
+            return f"BpmResult(rejected={self.rejected!r})"
+        return f"BpmResult({self.bpm_str}, phase={self.beat_phase}, confidence={self.confidence:.2f})"
+
+
+class RingBuffer:
+    # Single writer (the PortAudio callback), any number of readers. Readers
+    # never lock: a seqlock. The writer announces how far it is writing
+    # before copying and publishes written after; a reader retries if the
+    # announced end reached into the region it copied.
+    def __init__(self, size: int, dtype=np.int16):
+        self.size = size
+        self.buffer = np.zeros(size, dtype=dtype)
+        self.written = 0
+        self.writing = 0  # written once the current write is done
+        self.written_at = perf_counter()  # when the newest sample was written
+
+    def write(self, samples: np.ndarray) -> None:
+        written = self.written + samples.size
+        self.writing = written
+        samples = samples[-self.size :]
+        start = (written - samples.size) % self.size
+        first = min(samples.size, self.size - start)
+        self.buffer[start : start + first] = samples[:first]
+        self.buffer[: samples.size - first] = samples[first:]
+        self.written_at = perf_counter()
+        self.written = written
+
+    def read_since(self, position: int) -> tuple:
+        while True:
+            written = self.written
+            samples = self.copy(written, min(written - position, self.size))
+            if self.writing - written <= self.size - samples.size:
+                return samples, written
+
+    def read(self, length=None) -> np.ndarray:
+        while True:
+            written = self.written
+            samples = self.copy(written, min(self.size if length is None else length, written, self.size))
+            if self.writing - written <= self.size - samples.size:
+                return samples
+
+    def copy(self, written: int, count: int) -> np.ndarray:
+        end = written % self.size
+        if end >= count:
+            return self.buffer[end - count : end].copy()
+        return np.concatenate((self.buffer[end - count :], self.buffer[:end]))
+
+
+class BpmAnalyzer:
+    def search_beat_events(signal_array: np.ndarray, frame_rate: int) -> np.ndarray:
+        # the loudest sample of every half-second window; the input is not
+        # modified. A window whose maximum is not positive yields its first
+        # sample that differs from the maximum, as the original in-place
+        # binarization did.
+        step_size = frame_rate // 2
+        count = -(-len(signal_array) // step_size)
+        padded = np.empty(count * step_size, dtype=signal_array.dtype)
+        padded[: len(signal_array)] = signal_array
+        windows = padded.reshape(count, step_size)
+        if padded.size > len(signal_array):
+            # the partial last window repeats its first sample, which can
+            # neither raise its maximum nor come before the original argmax
+            windows[-1, len(signal_array) - (count - 1) * step_size :] = windows[-1, 0]
+        maxima = windows.max(axis=1, keepdims=True)
+        positive = maxima[:, 0] > 0
+        events = np.where(
+            positive,
+            np.argmax(windows == maxima, axis=1),
+            np.where(maxima[:, 0] < 0, np.argmax(windows != maxima, axis=1), 0),
+        )
+        return events.astype(np.int64) + np.arange(count, dtype=np.int64) * step_size
+
+    def search_onsets(signal_array: np.ndarray, frame_rate: int, sensitivity=3.0) -> tuple:
+        # every onset with its strength: the positive flux of the log energy
+        # in ~5.8 ms frames, peaks above the moving mean + sensitivity * std
+        # of the flux over half a second, at least 0.1 s apart. Positions are
+        # refined to the loudest sample of the peak frame.
+        frame = frame_rate // 172
+        framed, flux = BpmAnalyzer.onset_flux(signal_array, frame)
+        sums = np.cumsum(np.pad(flux, (44, 43), mode="edge"))
+        squares = np.cumsum(np.pad(flux * flux, (44, 43), mode="edge"))
+        mean = (sums[87:] - sums[:-87]) / 87
+        std = np.sqrt(np.maximum((squares[87:] - squares[:-87]) / 87 - mean * mean, 0))
+        gap = np.lib.stride_tricks.sliding_window_view(np.pad(flux, 17), 35).max(axis=1)
+        peaks = np.flatnonzero((flux > mean + sensitivity * std) & (flux == gap) & (flux > 0))
+        refined = np.abs(framed[peaks]).argmax(axis=1)
+        return peaks * frame + refined, flux[peaks]
+
+    def onset_flux(signal_array: np.ndarray, frame: int) -> tuple:
+        # the signal in frames of frame samples and the positive flux of
+        # their log energy
+        frames = len(signal_array) // frame
+        framed = np.asarray(signal_array[: frames * frame], dtype=np.float32).reshape(frames, frame)
+        envelope = np.log1p(np.einsum("ij,ij->i", framed, framed, dtype=np.float64))
+        return framed, np.maximum(np.diff(envelope, prepend=envelope[:1]), 0)
+
+    def bpm_container(
+        beat_events: np.ndarray, pattern_matcher: PatternMatcher, steps: int, tolerance=BPM_PATTERN.offset_step
+    ) -> np.ndarray:
+        _, tempos, offsets = pattern_matcher.match(beat_events, tolerance)
+        votes = np.bincount(
+            tempos * pattern_matcher.offsets + offsets, minlength=steps * pattern_matcher.offsets
+        )
+        return votes.reshape(steps, pattern_matcher.offsets)
+
+    def finalise_bpm_container(bpm_container: np.ndarray) -> np.ndarray:
+        # offset column 0 never counts as a vote
+        bpm_container_final = bpm_container[:, 1:].max(axis=1, keepdims=True)
+        if not bpm_container_final.all():
+            raise ValueError("tempo without any votes")
+        return bpm_container_final
+
+    def get_bpm_wrapped(bpm_container_final: np.ndarray) -> np.ndarray:
+        return np.where(bpm_container_final == np.amax(bpm_container_final))
+
+    def rejection(bpm_wrapped: np.ndarray, bpm_container_final: np.ndarray) -> str:
+        count = np.count_nonzero(bpm_container_final == bpm_wrapped[0][0])
+        if count > 1:
+            return "ambiguous"
+        if bpm_container_final[int(bpm_wrapped[0][0])] < 6:
+            return "fewer than 6 votes"
+        return None
+
+    def candidates(votes: np.ndarray, count=5, bpm_pattern=BPM_PATTERN) -> tuple:
+        # strongest coarse rows, skipping rows within 1 BPM of a stronger one
+        rows = []
+        for row in np.argsort(-votes, kind="stable"):
+            if votes[row] == 0 or len(rows) == count:
+                break
+            if all(abs(int(row) - other) * bpm_pattern.step >= 1 for other in rows):
+                rows.append(int(row))
+        return tuple((round(float(bpm_pattern.bpms[row]), 2), int(votes[row])) for row in rows)
+
+    def alternatives(bpm_float: float, votes: np.ndarray, bpm_pattern=BPM_PATTERN) -> dict:
+        alternatives = {}
+        for name, ratio in [("half", 0.5), ("double", 2.0)]:
+            row = int(round((bpm_float * ratio - bpm_pattern.bpms[0]) / bpm_pattern.step))
+            in_range = 0 <= row < len(votes)
+            alternatives[name] = (round(bpm_float * ratio, 2), int(votes[row]) if in_range else None)
+        return alternatives
+
+    # built on first use, so importing the module stays cheap
+    @functools.lru_cache(maxsize=1)
+    def coarse_pattern_matcher() -> PatternMatcher:
+        if PATTERN_CACHE:
+            os.makedirs(PATTERN_CACHE, exist_ok=True)
+            BPM_PATTERN_FINE.use_cache("bpm_pattern_fine", PATTERN_CACHE)
+            return PatternMatcher.cached(BPM_PATTERN, "bpm_pattern_index", PATTERN_CACHE)
+        return PatternMatcher(BPM_PATTERN)
+
+    @functools.lru_cache(maxsize=1)
+    def decimated_pattern_matcher() -> PatternMatcher:
+        if PATTERN_CACHE:
+            os.makedirs(PATTERN_CACHE, exist_ok=True)
+            return PatternMatcher.cached(BPM_PATTERN_DECIMATED, "bpm_pattern_decimated_index", PATTERN_CACHE)
+        return PatternMatcher(BPM_PATTERN_DECIMATED)
+
+    @functools.lru_cache(maxsize=16)
+    def fine_pattern_matcher(start: int, end: int) -> PatternMatcher:
+        return PatternMatcher(BPM_PATTERN_FINE[start:end])
+
+    def get_bpm_pattern_fine_window(bpm_wrapped: np.ndarray) -> int:
+        start = int(((bpm_wrapped[0][0] * BPM_PATTERN.step) / BPM_PATTERN_FINE.step) - FINE_WINDOW)
+        end = int(start + 2 * FINE_WINDOW)
+        return start, end
+
+    def bpm_wrapped_to_float_str(bpm: np.ndarray, bpm_fine: np.ndarray) -> float:
+        bpm_float = round(
+            float(
+                (((bpm[0][0] * BPM_PATTERN.step) + BPM_PATTERN.min_bpm) - FINE_WINDOW * BPM_PATTERN_FINE.step)
+                + (bpm_fine[0][0] * BPM_PATTERN_FINE.step)
+            ),
+            2,
+        )
+        bpm_str = format(bpm_float, ".2f")
+        return bpm_float, bpm_str
+
+    def beat_phase(bpm_container: np.ndarray, bpm_wrapped: np.ndarray, start: int, end: int, length: int) -> float:
+        # the winning offset column of the winning fine row is where its beat
+        # grid starts; returns how far into a beat the buffer ends (0 to 1)
+        row = int(bpm_wrapped[0][0])
+        offset = BPM_PATTERN_FINE.offsets[np.argmax(bpm_container[row, 1:]) + 1]
+        period = BPM_PATTERN_FINE.periods[start:end][row]
+        return round(float((length - offset) % period / period), 3)
+
+    def search_bpm(signal_array: np.ndarray, frame_rate: int) -> BpmResult:
+        if MULTI_RATE:
+            return BpmAnalyzer.search_bpm_multi_rate(signal_array, frame_rate)
+        started = perf_counter()
+        if ONSET_DETECTOR == "onsets":
+            beat_events, _ = BpmAnalyzer.search_onsets(signal_array, frame_rate)
+        else:
+            beat_events = BpmAnalyzer.search_beat_events(signal_array, frame_rate)
+        if Metrics.METRICS is not None:
+            Metrics.METRICS.observe("analysis_stage_seconds", perf_counter() - started, stage="events")
+        return BpmAnalyzer.search_bpm_in_events(beat_events, len(signal_array))
+
+    def search_bpm_in_events(beat_events: np.ndarray, length: int) -> BpmResult:
+        # length is the number of samples the beat events were found in
+        # kept in a local: concurrent first calls may each build their own
+        coarse_pattern_matcher = BpmAnalyzer.coarse_pattern_matcher()
+        pattern_matcher = coarse_pattern_matcher
+        candidates = ()
+        for switch_pattern in [len(BPM_PATTERN), 2 * FINE_WINDOW]:
+            stage = "coarse" if pattern_matcher is coarse_pattern_matcher else "fine"
+            started = perf_counter()
+            bpm_container = BpmAnalyzer.bpm_container(
+                beat_events, pattern_matcher, switch_pattern
+            )
+            if Metrics.METRICS is not None:
+                Metrics.METRICS.observe("analysis_stage_seconds", perf_counter() - started, stage=stage)
+            if stage == "coarse":
+                coarse_votes = bpm_container[:, 1:].max(axis=1)
+                candidates = BpmAnalyzer.candidates(coarse_votes)
+            try:
+                bpm_container_final = BpmAnalyzer.finalise_bpm_container(bpm_container)
+            except ValueError:
+                return BpmResult(candidates=candidates, rejected=f"{stage}: tempo without any votes")
+            bpm_wrapped = BpmAnalyzer.get_bpm_wrapped(bpm_container_final)
+            if reason := BpmAnalyzer.rejection(bpm_wrapped, bpm_container_final):
+                return BpmResult(candidates=candidates, rejected=f"{stage}: {reason}")
+            if pattern_matcher is coarse_pattern_matcher:
+                start, end = BpmAnalyzer.get_bpm_pattern_fine_window(bpm_wrapped)
+                pattern_matcher = BpmAnalyzer.fine_pattern_matcher(start, end)
+                bpm_wrapped_full_range = bpm_wrapped
+            else:
+                bpm_wrapped_fine_range = bpm_wrapped
+                bpm_float, bpm_str = BpmAnalyzer.bpm_wrapped_to_float_str(
+                    bpm_wrapped_full_range, bpm_wrapped_fine_range
+                )
+                return BpmResult(
+                    bpm_float,
+                    bpm_str,
+                    BpmAnalyzer.beat_phase(bpm_container, bpm_wrapped, start, end, length),
+                    min(float(bpm_container_final.max()) / max(beat_events.size, 1), 1.0),
+                    candidates,
+                    BpmAnalyzer.alternatives(bpm_float, coarse_votes),
+                )
+
+    def search_bpm_multi_rate(signal_array: np.ndarray, frame_rate: int) -> BpmResult:
+        count = len(signal_array) // DECIMATION
+        envelope = np.asarray(signal_array[: count * DECIMATION]).reshape(count, DECIMATION).max(axis=1)
+        envelope_events = BpmAnalyzer.search_beat_events(envelope, int(round(frame_rate / DECIMATION)))
+        if ONSET_DETECTOR == "onsets":
+            beat_events, _ = BpmAnalyzer.search_onsets(signal_array, frame_rate)
+        else:
+            beat_events = BpmAnalyzer.search_beat_events(signal_array, frame_rate)
+        return BpmAnalyzer.search_bpm_in_envelope(envelope_events, beat_events, len(signal_array))
+
+    def search_bpm_in_envelope(envelope_events: np.ndarray, beat_events: np.ndarray, length: int) -> BpmResult:
+        # coarse pass on the decimated envelope, fine pass on the full rate
+        # beat events within FINE_WINDOW of the coarse winner
+        bpm_container = BpmAnalyzer.bpm_container(
+            envelope_events,
+            BpmAnalyzer.decimated_pattern_matcher(),
+            len(BPM_PATTERN_DECIMATED),
+            DECIMATED_TOLERANCE,
+        )
+        coarse_votes = bpm_container[:, 1:].max(axis=1)
+        candidates = BpmAnalyzer.candidates(coarse_votes, bpm_pattern=BPM_PATTERN_DECIMATED)
+        try:
+            bpm_container_final = BpmAnalyzer.finalise_bpm_container(bpm_container)
+        except ValueError:
+            return BpmResult(candidates=candidates, rejected="decimated: tempo without any votes")
+        bpm_wrapped = BpmAnalyzer.get_bpm_wrapped(bpm_container_final)
+        if reason := BpmAnalyzer.rejection(bpm_wrapped, bpm_container_final):
+            return BpmResult(candidates=candidates, rejected=f"decimated: {reason}")
+        coarse_bpm = bpm_wrapped[0][0] * BPM_PATTERN_DECIMATED.step + BPM_PATTERN_DECIMATED.min_bpm
+        center = int(round((coarse_bpm - BPM_PATTERN_FINE.min_bpm) / BPM_PATTERN_FINE.step))
+        start, end = max(center - FINE_WINDOW, 0), min(center + FINE_WINDOW + 1, len(BPM_PATTERN_FINE))
+        bpm_container = BpmAnalyzer.bpm_container(beat_events, BpmAnalyzer.fine_pattern_matcher(start, end), end - start)
+        try:
+            bpm_container_final = BpmAnalyzer.finalise_bpm_container(bpm_container)
+        except ValueError:
+            return BpmResult(candidates=candidates, rejected="fine: tempo without any votes")
+        bpm_wrapped = BpmAnalyzer.get_bpm_wrapped(bpm_container_final)
+        if reason := BpmAnalyzer.rejection(bpm_wrapped, bpm_container_final):
+            return BpmResult(candidates=candidates, rejected=f"fine: {reason}")
+        bpm_float = round(float(BPM_PATTERN_FINE.min_bpm + (start + bpm_wrapped[0][0]) * BPM_PATTERN_FINE.step), 2)
+        return BpmResult(
+            bpm_float,
+            format(bpm_float, ".2f"),
+            BpmAnalyzer.beat_phase(bpm_container, bpm_wrapped, start, end, length),
+            min(float(bpm_container_final.max()) / max(beat_events.size, 1), 1.0),
+            candidates,
+            BpmAnalyzer.alternatives(bpm_float, coarse_votes, BPM_PATTERN_DECIMATED),
+        )
+
+    def run_analyzer(modules: object) -> None:
+        modules.analysis_scheduler.run(modules.threading_events.stop_analyzer)
+
+    def store_bpm(bpm_storage: BpmStorage, bpm_float: float, weight=1.0) -> None:
+        bpm_tracked = round(bpm_storage.tempo_tracker.update(bpm_float, weight), 2)
+        bpm_storage._float, bpm_storage._str = bpm_tracked, format(bpm_tracked, ".2f")
+
+
+class AutocorrelationEngine:
+    # Scores every tempo of the fine grid by the autocorrelation of the onset
+    # envelope at 1 to BEATS beat periods, interpolated between envelope
+    # frames. The autocorrelation is computed with one FFT pair per pass, so
+    # the cost does not grow with the tempo range or the number of onsets.
+    FRAME = FRAME_RATE // 172
+    BEATS = 16
+    BPMS = np.round(np.arange(len(BPM_PATTERN_FINE)) * BPM_PATTERN_FINE.step + MIN_BPM, 2)
+
+    def search_bpm(signal_array: np.ndarray, frame_rate: int) -> BpmResult:
+        frame = frame_rate // 172
+        _, flux = BpmAnalyzer.onset_flux(signal_array, frame)
+        return AutocorrelationEngine.search_bpm_in_envelope(flux, frame_rate / frame, frame, len(signal_array))
+
+    def search_bpm_in_events(beat_events: np.ndarray, length: int) -> BpmResult:
+        # the beat events as an impulse train at the envelope rate
+        frame = AutocorrelationEngine.FRAME
+        frames = max(length // frame, 1)
+        envelope = np.bincount(np.minimum(beat_events // frame, frames - 1), minlength=frames).astype(np.float64)
+        return AutocorrelationEngine.search_bpm_in_envelope(envelope, FRAME_RATE / frame, frame, length)
+
+    def autocorrelation(envelope: np.ndarray) -> np.ndarray:
+        # unbiased: every lag is divided by the number of frames it overlaps
+        centered = envelope - envelope.mean()
+        spectrum = np.fft.rfft(centered, 2 * centered.size)
+        acf = np.fft.irfft(spectrum.real**2 + spectrum.imag**2)[: centered.size]
+        return acf / np.arange(centered.size, 0, -1)
+
+    def comb_scores(acf: np.ndarray, envelope_rate: float, bpms: np.ndarray) -> np.ndarray:
+        lags = np.arange(1, AutocorrelationEngine.BEATS + 1)[:, None] * (60 * envelope_rate / bpms)
+        return np.interp(lags, np.arange(acf.size), acf, right=0.0).sum(axis=0) / AutocorrelationEngine.BEATS
+
+    def candidates(scores: np.ndarray, count=5) -> tuple:
+        # strongest tempos, skipping tempos within 1 BPM of a stronger one
+        bpms = AutocorrelationEngine.BPMS
+        found = []
+        for index in np.argsort(-scores, kind="stable"):
+            if scores[index] <= 0 or len(found) == count:
+                break
+            if all(abs(bpms[index] - bpm) >= 1 for bpm, _ in found):
+                found.append((float(bpms[index]), round(float(scores[index]), 3)))
+        return tuple(found)
+
+    def beat_phase(envelope: np.ndarray, period: float, frame: int, length: int) -> float:
+        # folds the envelope onto one beat period; the strongest bin is where
+        # the beat grid starts
+        bins = max(int(round(period)), 1)
+        folded = np.bincount((np.arange(envelope.size) % period * bins / period).astype(np.int64) % bins, envelope, bins)
+        offset = (np.argmax(folded) + 0.5) * period / bins * frame
+        return round(float((length - offset) % (period * frame) / (period * frame)), 3)
+
+    def search_bpm_in_envelope(envelope: np.ndarray, envelope_rate: float, frame: int, length: int) -> BpmResult:
+        acf = AutocorrelationEngine.autocorrelation(envelope)
+        if acf.size < 2 or acf[0] <= 0:
+            return BpmResult(rejected="autocorrelation: no onsets")
+        scores = AutocorrelationEngine.comb_scores(acf, envelope_rate, AutocorrelationEngine.BPMS) / acf[0]
+        candidates = AutocorrelationEngine.candidates(scores)
+        if not candidates:
+            return BpmResult(rejected="autocorrelation: no periodicity")
+        bpm_float = candidates[0][0]
+        alternatives = {}
+        for name, ratio in [("half", 0.5), ("double", 2.0)]:
+            bpm = round(bpm_float * ratio, 2)
+            score = None
+            if MIN_BPM <= bpm <= MAX_BPM:
+                score = round(float(AutocorrelationEngine.comb_scores(acf, envelope_rate, np.array([bpm]))[0] / acf[0]), 3)
+            alternatives[name] = (bpm, score)
+        return BpmResult(
+            bpm_float,
+            format(bpm_float, ".2f"),
+            AutocorrelationEngine.beat_phase(envelope, 60 * envelope_rate / bpm_float, frame, length),
+            min(max(candidates[0][1], 0.0), 1.0),
+            candidates,
+            alternatives,
+        )
+
+
+# a tempo engine provides search_bpm(signal_array, frame_rate) for a filtered
+# buffer and search_bpm_in_events(beat_events, length) for the streaming
+# analyzer, both returning a BpmResult
+TEMPO_ENGINES = {"voting": BpmAnalyzer, "autocorrelation": AutocorrelationEngine}
+
+
+def tempo_engine(name=None) -> type:
+    name = TEMPO_ENGINE if name is None else name
+    if name not in TEMPO_ENGINES:
+        raise ValueError(f"unknown tempo engine {name!r}, expected one of {', '.join(TEMPO_ENGINES)}")
+    return TEMPO_ENGINES[name]
+
+
+class BandpassFilter:
+    # Butterworth bandpass as second-order sections. The design is cached per
+    # (lowcut, highcut, frame_rate, order) and blocks are filtered in float32;
+    # with stateful=True consecutive blocks are filtered as one signal.
+    def __init__(self, frame_rate: int, lowcut=60.0, highcut=3000.0, order=6, stateful=False, dtype=np.float32):
+        self.frame_rate = frame_rate
+        self.order = order
+        self.stateful = stateful
+        self.dtype = dtype
+        self.set_band(lowcut, highcut)
+
+    @functools.lru_cache(maxsize=32)
+    def design(lowcut: float, highcut: float, frame_rate: int, order: int) -> np.ndarray:
+        from scipy import signal
+
+        nyq = 0.5 * frame_rate
+        return signal.butter(order, [lowcut / nyq, highcut / nyq], btype="band", output="sos")
+
+    def set_band(self, lowcut: float, highcut: float) -> None:
+        self.lowcut, self.highcut = lowcut, highcut
+        self.sos = None  # designed with the next block
+        self.reset()
+
+    def reset(self) -> None:
+        self.state = None
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        from scipy import signal
+
+        if self.sos is None:
+            self.sos = BandpassFilter.design(self.lowcut, self.highcut, self.frame_rate, self.order).astype(self.dtype)
+        block = np.asarray(block, dtype=self.dtype)
+        if not self.stateful:
+            return signal.sosfilt(self.sos, block)
+        if self.state is None:
+            self.state = np.zeros((self.sos.shape[0], 2), dtype=self.dtype)
+        filtered, self.state = signal.sosfilt(self.sos, block, zi=self.state)
+        return filtered
+
+
+BANDPASS_FILTER = BandpassFilter(FRAME_RATE)
+
+
+class StreamingAnalyzer:
+    # Filters and scans only the audio that arrived since the last pass. The
+    # filter state and the beat events of completed half-second windows are
+    # kept, and events older than the operating range are expired.
+    def __init__(self, frame_rate: int, operating_range_seconds=12, lowcut=60.0, highcut=3000.0):
+        self.bandpass_filter = BandpassFilter(frame_rate, lowcut, highcut, stateful=True)
+        self.frame_rate = frame_rate
+        self.step_size = frame_rate // 2
+        self.window_count = int(frame_rate * operating_range_seconds) // self.step_size
+        self.read_position = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.bandpass_filter.reset()
+        self.pending = np.zeros(0, dtype=self.bandpass_filter.dtype)
+        self.events = deque(maxlen=self.window_count)
+        self.windows_done = 0
+
+    def process(self, samples: np.ndarray) -> None:
+        pending = np.concatenate((self.pending, self.bandpass_filter.process(samples)))
+        complete = pending.size // self.step_size * self.step_size
+        events = BpmAnalyzer.search_beat_events(pending[:complete], self.frame_rate)
+        self.events.extend(events + self.windows_done * self.step_size)
+        self.windows_done += complete // self.step_size
+        self.pending = pending[complete:]
+
+    def beat_events(self) -> np.ndarray:
+        oldest_window = self.windows_done - len(self.events)
+        return np.array(self.events, dtype=np.int64) - oldest_window * self.step_size
+
+    def length(self) -> int:
+        # samples covered by beat_events(), counted from the oldest window
+        return len(self.events) * self.step_size + self.pending.size
+
+    def consume(self, samples: np.ndarray, written: int) -> np.ndarray:
+        if written - self.read_position != samples.size:
+            self.reset()  # lapped by the writer, the stream is no longer continuous
+        self.read_position = written
+        self.process(samples)
+        return self.beat_events()
+
+
+class AnalysisScheduler:
+    # Runs at most one analysis pass per hop, always on the newest audio, and
+    # idles while no new audio arrives. A pass that overruns its hop is late;
+    # the hops it overran are skipped instead of queued, so results never fall
+    # more than one pass behind. Changed BPMs are pushed to the subscribers.
+    def __init__(
+        self,
+        signal_buffer: RingBuffer,
+        buffer_updated: threading.Event,
+        bpm_storage: BpmStorage,
+        frame_rate=FRAME_RATE,
+        hop_seconds=ANALYSIS_HOP_SECONDS,
+        streaming=None,
+        min_confidence=MIN_CONFIDENCE,
+        engine=None,
+    ):
+        self.signal_buffer = signal_buffer
+        self.buffer_updated = buffer_updated
+        self.bpm_storage = bpm_storage
+        self.frame_rate = frame_rate
+        self.hop_seconds = hop_seconds
+        self.min_confidence = min_confidence
+        self.engine = tempo_engine(engine)
+        streaming = STREAMING_ANALYZER if streaming is None else streaming
+        self.streaming_analyzer = StreamingAnalyzer(frame_rate) if streaming else None
+        self.subscribers = []
+        self.beat_subscribers = []
+        self.result_subscribers = []
+        self.analyzed = 0  # ring buffer position of the last analyzed window
+        self.captured = perf_counter()  # when its newest sample was written
+        self.passes = 0
+        self.skipped = 0
+        self.late = 0
+        self.rejected = 0
+        self.pass_seconds = deque(maxlen=100)
+        if Metrics.METRICS is not None:
+            for name in ["passes", "late", "skipped", "rejected"]:
+                Metrics.METRICS.gauge(f"analysis_{name}", functools.partial(getattr, self, name))
+
+    def subscribe(self, callback) -> None:
+        # called from the analyzer thread as callback(bpm_float, bpm_str)
+        self.subscribers.append(callback)
+
+    def subscribe_beat(self, callback) -> None:
+        # called after every accepted pass as callback(bpm_float, beat_phase,
+        # captured) with the unaveraged tempo; the last beat was
+        # beat_phase * 60 / bpm_float seconds before the perf_counter time captured
+        self.beat_subscribers.append(callback)
+
+    def subscribe_result(self, callback) -> None:
+        # called after every pass, accepted or not, as callback(result,
+        # captured) before the tempo is published
+        self.result_subscribers.append(callback)
+
+    def subscribe_queue(self) -> queue.Queue:
+        # holds only the latest BPM, a slow reader never sees stale values
+        updates = queue.Queue(maxsize=1)
+
+        def put_latest(*bpm_float_str) -> None:
+            try:
+                updates.get_nowait()
+            except queue.Empty:
+                pass
+            updates.put_nowait(bpm_float_str)
+
+        self.subscribe(put_latest)
+        return updates
+
+    def analyze(self) -> BpmResult:
+        if self.streaming_analyzer:
+            samples, written = self.signal_buffer.read_since(self.streaming_analyzer.read_position)
+            self.analyzed, self.captured = written, self.signal_buffer.written_at
+            beat_events = self.streaming_analyzer.consume(samples, written)
+            return self.engine.search_bpm_in_events(beat_events, self.streaming_analyzer.length())
+        self.analyzed, self.captured = self.signal_buffer.written, self.signal_buffer.written_at
+        started = perf_counter()
+        buffer = BANDPASS_FILTER.process(self.signal_buffer.read())
+        if Metrics.METRICS is not None:
+            Metrics.METRICS.observe("analysis_stage_seconds", perf_counter() - started, stage="filter")
+        return self.engine.search_bpm(buffer, self.frame_rate)
+
+    def run(self, stop_event: threading.Event) -> None:
+        next_pass = perf_counter()
+        while not stop_event.is_set():
+            if self.signal_buffer.written == self.analyzed:
+                self.buffer_updated.wait(0.5)
+                self.buffer_updated.clear()
+                continue
+            started = perf_counter()
+            if started < next_pass:
+                stop_event.wait(next_pass - started)
+                continue
+            if Metrics.METRICS is not None:
+                self.observe_buffer(Metrics.METRICS)
+            result = self.analyze()
+            finished = perf_counter()
+            self.passes += 1
+            self.pass_seconds.append(finished - started)
+            next_pass = started + self.hop_seconds
+            if self.hop_seconds and finished > next_pass:
+                self.late += 1
+                self.skipped += int((finished - next_pass) / self.hop_seconds)
+                next_pass = finished
+            for subscriber in self.result_subscribers:
+                subscriber(result, self.captured)
+            if result and result.confidence >= self.min_confidence:
+                self.publish(result.bpm, result.confidence)
+                for subscriber in self.beat_subscribers:
+                    subscriber(result.bpm, result.beat_phase, self.captured)
+            else:
+                self.rejected += 1
+            if Metrics.METRICS is not None:
+                self.observe_pass(Metrics.METRICS, finished - started, result)
+
+    def observe_buffer(self, metrics: Metrics.Metrics) -> None:
+        written = self.signal_buffer.written
+        metrics.observe("analysis_backlog_seconds", (written - self.analyzed) / self.frame_rate)
+        metrics.observe(
+            "signal_buffer_fill", min(written, self.signal_buffer.size) / self.signal_buffer.size, Metrics.RATIO_BUCKETS
+        )
+
+    def observe_pass(self, metrics: Metrics.Metrics, seconds: float, result: BpmResult) -> None:
+        metrics.observe("analysis_pass_seconds", seconds)
+        if not result:
+            metrics.increment("analysis_rejections_total", reason=result.rejected)
+        elif result.confidence < self.min_confidence:
+            metrics.increment("analysis_rejections_total", reason="low confidence")
+        else:
+            metrics.increment("analysis_results_total")
+
+    def publish(self, bpm_float: float, weight=1.0) -> None:
+        previous = self.bpm_storage._str
+        BpmAnalyzer.store_bpm(self.bpm_storage, bpm_float, weight)
+        if self.bpm_storage._str != previous:
+            for subscriber in self.subscribers:
+                subscriber(self.bpm_storage._float, self.bpm_storage._str)
+
+
+def bandpass_filter(audio_signal, lowcut=60.0, highcut=3000.0) -> np.ndarray:
+    return BandpassFilter(FRAME_RATE, lowcut, highcut).process(audio_signal)
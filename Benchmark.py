@@ -0,0 +1,1384 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from time import perf_counter, process_time, sleep
+
+import numpy as np
+from scipy import signal
+
+from AnalyzerCore import (
+    BPM_PATTERN,
+    BANDPASS_FILTER,
+    BPM_PATTERN_FINE,
+    FRAME_RATE,
+    MAX_BPM,
+    MIN_BPM,
+    AnalysisScheduler,
+    BandpassFilter,
+    BpmAnalyzer,
+    BpmResult,
+    RingBuffer,
+    bandpass_filter,
+    tempo_engine,
+)
+
+
+def click_track(bpm: float, frame_rate: int, seconds=12, phase=0.0, noise=0.05, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    length = int(frame_rate * seconds)
+    signal_array = rng.normal(0, noise, length)
+    period = 60 / bpm * frame_rate
+    click = np.sin(np.arange(200) * 2 * np.pi * 120 / frame_rate) * np.exp(-np.arange(200) / 60)
+    for beat in np.arange(phase * period, length, period).astype(np.int64):
+        end = min(beat + click.size, length)
+        signal_array[beat:end] += click[: end - beat]
+    return (signal_array / np.abs(signal_array).max() * 20000).astype(np.int16)
+
+
+def drum_loop(bpm: float, frame_rate: int, seconds=12, phase=0.0, swing=0.0, seed=0) -> np.ndarray:
+    # kick on 1 and 3, snare on 2 and 4, hi-hat on every eighth; swing delays
+    # the off-beat eighths by that fraction of an eighth
+    rng = np.random.default_rng(seed)
+    length = int(frame_rate * seconds)
+    signal_array = np.zeros(length)
+    period = 60 / bpm * frame_rate
+    t = np.arange(int(0.25 * frame_rate)) / frame_rate
+    kick = np.sin(2 * np.pi * (50 * t + 350 * (1 - np.exp(-t * 30)) / 30)) * np.exp(-t * 12)
+    snare = (rng.normal(0, 0.5, t.size) + 0.5 * np.sin(2 * np.pi * 190 * t)) * np.exp(-t * 25)
+    hihat = np.diff(rng.normal(0, 0.15, t.size + 1)) * np.exp(-t * 80)
+    for eighth, start in enumerate(np.arange(phase * period, length, period / 2)):
+        if eighth % 2:
+            start += swing * period / 2
+        sounds = [hihat]
+        if eighth % 4 == 0:
+            sounds.append(kick)
+        elif eighth % 4 == 2:
+            sounds.append(snare * 0.6)
+        start = int(start)
+        end = min(start + t.size, length)
+        if start >= length:
+            break
+        for sound in sounds:
+            signal_array[start:end] += sound[: end - start]
+    return signal_array
+
+
+def degrade(signal_array: np.ndarray, frame_rate: int, degradation: str, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    signal_array = signal_array / np.abs(signal_array).max()
+    rms = np.sqrt(np.mean(signal_array**2))
+    if degradation == "noise":
+        # 6 dB signal to noise ratio
+        signal_array = signal_array + rng.normal(0, rms / 2, signal_array.size)
+    elif degradation == "dropouts":
+        # five 300 ms gaps
+        gap = int(0.3 * frame_rate)
+        for start in rng.integers(0, signal_array.size - gap, 5):
+            signal_array[start : start + gap] = 0
+    elif degradation == "mic":
+        # a phone-grade microphone: 200 Hz - 4 kHz, clipped, 8 bit, hiss and hum
+        sos = signal.butter(2, [200, 4000], btype="band", fs=frame_rate, output="sos")
+        signal_array = np.tanh(3 * signal.sosfilt(sos, signal_array))
+        signal_array = np.round(signal_array * 127) / 127
+        hum = 0.05 * np.sin(2 * np.pi * 50 * np.arange(signal_array.size) / frame_rate)
+        signal_array = signal_array + hum + rng.normal(0, rms / 10, signal_array.size)
+    return (signal_array / np.abs(signal_array).max() * 20000).astype(np.int16)
+
+
+def test_signals(count: int, seed=0) -> list[tuple]:
+    rng = np.random.default_rng(seed)
+    signals = []
+    for i in range(count):
+        bpm = rng.uniform(101, 159)
+        signal_array = click_track(
+            bpm, FRAME_RATE, phase=rng.uniform(), noise=rng.uniform(0.01, 0.3), seed=seed + i
+        )
+        signals.append((bpm, signal_array))
+    return signals
+
+
+def timed(function, *args, repeat=3) -> tuple:
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function(*args)
+        best = min(best, perf_counter() - start)
+    return best, result
+
+
+# The original voting pipeline: a dense comparison over the pattern per beat
+# event, Python lists per (event, tempo) and np.unique per tempo row.
+def bpm_container_reference(beat_events: np.ndarray, bpm_pattern: np.ndarray, steps: int) -> np.ndarray:
+    bpm_container = [list(np.zeros((1,), dtype=np.int64)) for _ in range(beat_events.size * steps)]
+    for i, beat_event in enumerate(beat_events):
+        found_in_pattern = np.where(np.logical_and(bpm_pattern >= beat_event - 20, bpm_pattern <= beat_event + 20))
+        for x, q in enumerate(found_in_pattern[0]):
+            bpm_container[i * steps + q].append(found_in_pattern[1][x])
+    bpm_container_final = np.zeros((steps, 1), dtype=np.int64)
+    for i in range(steps):
+        w = [item for sublist in bpm_container[i::steps] for item in sublist]
+        w = list(filter(lambda num: num != 0, w))
+        values, counts = np.unique(w, return_counts=True)
+        bpm_container_final[i] = counts.max()
+    return bpm_container_final
+
+
+def replay_buffers(args) -> list[np.ndarray]:
+    if args.buffers:
+        return list(np.load(args.buffers))
+    return [signal_array for _, signal_array in test_signals(args.signals)]
+
+
+def finalised(bpm_container: np.ndarray):
+    try:
+        return BpmAnalyzer.finalise_bpm_container(bpm_container)
+    except ValueError:
+        return None
+
+
+def bench_voting(args) -> None:
+    buffers = replay_buffers(args)
+    before_total, after_total, passes_total, mismatches = 0.0, 0.0, 0, 0
+    for signal_array in buffers:
+        beat_events = BpmAnalyzer.search_beat_events(bandpass_filter(signal_array), FRAME_RATE)
+        passes = [(BPM_PATTERN[:], BpmAnalyzer.coarse_pattern_matcher(), 240)]
+        for bpm_pattern, pattern_matcher, steps in passes:
+            try:
+                before, expected = timed(bpm_container_reference, beat_events, bpm_pattern, steps, repeat=1)
+            except ValueError:
+                before, expected = 0.0, None
+            after, result = timed(
+                lambda: finalised(
+                    BpmAnalyzer.bpm_container(beat_events, pattern_matcher, steps)
+                ),
+                repeat=args.repeat,
+            )
+            before_total += before
+            after_total += after
+            passes_total += 1
+            mismatches += not np.array_equal(result, expected)
+            if steps == 240 and result is not None:
+                bpm_wrapped = BpmAnalyzer.get_bpm_wrapped(result)
+                start, end = BpmAnalyzer.get_bpm_pattern_fine_window(bpm_wrapped)
+                pattern_matcher = BpmAnalyzer.fine_pattern_matcher(start, end)
+                passes.append((BPM_PATTERN_FINE[start:end], pattern_matcher, 40))
+    print(f"buffers:     {len(buffers)}")
+    print(f"passes:      {passes_total}")
+    print(f"before:      {before_total / len(buffers) * 1000:9.2f} ms/buffer")
+    print(f"after:       {after_total / len(buffers) * 1000:9.2f} ms/buffer")
+    print(f"speedup:     {before_total / after_total:9.1f}x")
+    print(f"mismatches:  {mismatches}")
+    if mismatches:
+        sys.exit(1)
+
+
+# The original generator from ExtractBpmPatterns.py: int64 patterns filled
+# element by element and saved as .npy files the app loaded at import.
+ORIGINAL_PATTERNS = """
+def extract_bpm_pattern(lengh: int, frame_rate: int) -> None:
+    array = np.full((240, lengh, 32), 0, dtype=np.int64)
+    jump = int(0)
+    add = 0
+
+    for i in range(240):
+        add += 0.25
+        timestamp = int(60 / (100 + add) * frame_rate)
+        jump = int(0)
+        for x in range(lengh):
+            timestamp_next = 0
+            jump += 20
+            for y in range(32):
+                array[i][x][y] = timestamp_next
+                timestamp_next += timestamp
+            array[i][x] = array[i][x] + jump
+
+    np.save(os.path.join(DIRECTORY, "bpm_pattern.npy"), array)
+
+
+def extract_bpm_pattern_fine(lengh: int, frame_rate: int) -> None:
+    array = np.full((1200, lengh, 32), 0, dtype=np.int64)
+    jump = int(0)
+    add = 0
+
+    for i in range(1200):
+        timestamp = int(60 / (100 + add) * frame_rate)
+        add += 0.05
+        jump = int(0)
+        for x in range(lengh):
+            timestamp_next = 0
+            jump += 20
+            for y in range(32):
+                array[i][x][y] = timestamp_next
+                timestamp_next += timestamp
+            array[i][x] = array[i][x] + jump
+
+    np.save(os.path.join(DIRECTORY, "bpm_pattern_fine.npy"), array)
+
+
+lengh = int((FRAME_RATE / 2) / 20)
+extract_bpm_pattern(lengh, FRAME_RATE)
+extract_bpm_pattern_fine(lengh, FRAME_RATE)
+"""
+
+STARTUP_PATHS = {
+    # the original loader, on the files ORIGINAL_PATTERNS wrote
+    "original": """
+patterns = np.load(os.path.join(DIRECTORY, "bpm_pattern.npy")), np.load(os.path.join(DIRECTORY, "bpm_pattern_fine.npy"))
+""",
+    "analytic": """
+import ExtractBpmPatterns
+from PatternMatcher import PatternMatcher
+patterns = (
+    PatternMatcher(ExtractBpmPatterns.BpmPattern.coarse(FRAME_RATE)),
+    ExtractBpmPatterns.BpmPattern.fine(FRAME_RATE),
+)
+""",
+    "cached": """
+import ExtractBpmPatterns
+from PatternMatcher import PatternMatcher
+patterns = (
+    PatternMatcher.cached(ExtractBpmPatterns.BpmPattern.coarse(FRAME_RATE), "bpm_pattern_index", DIRECTORY),
+    ExtractBpmPatterns.BpmPattern.fine(FRAME_RATE).use_cache("bpm_pattern_fine", DIRECTORY),
+)
+""",
+}
+
+
+def measure_startup(code: str, directory: str) -> dict:
+    # resident memory of the child process before and after loading, once
+    # malloc has returned freed memory to the OS: on Linux split into
+    # anonymous pages and file-backed (memory-mapped, shared with other
+    # processes mapping the same file) pages, elsewhere the peak
+    script = f"""
+import json, os, sys
+from time import perf_counter
+sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})
+import numpy as np
+FRAME_RATE = {FRAME_RATE}
+DIRECTORY = {directory!r}
+
+def resident():
+    try:
+        with open("/proc/self/status") as status:
+            fields = dict(line.split(":", 1) for line in status)
+        return {{name: int(fields[name].split()[0]) / 2**10 for name in ("VmRSS", "RssAnon", "RssFile")}}
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {{"VmRSS": peak / (2**20 if sys.platform == "darwin" else 2**10), "RssAnon": None, "RssFile": None}}
+
+def trim():
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass  # not glibc
+
+trim()
+before = resident()
+start = perf_counter()
+{code}
+seconds = perf_counter() - start
+trim()
+after = resident()
+print(json.dumps({{
+    "seconds": seconds,
+    **{{name: None if after[name] is None else after[name] - before[name] for name in after}},
+}}))
+"""
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def bench_startup(args) -> None:
+    def mb(value) -> str:
+        return "      -" if value is None else f"{value:7.1f}"
+
+    directory = tempfile.mkdtemp(prefix="bpm-startup-")
+    try:
+        if "original" in args.paths:
+            generated = measure_startup(ORIGINAL_PATTERNS, directory)
+            size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+            print(f"original generator {generated['seconds']:7.1f} s   {size / 2**20:7.1f} MB of .npy files")
+        for name in args.paths:
+            measured = [measure_startup(STARTUP_PATHS[name], directory) for _ in range(args.repeat)]
+            best = min(measured, key=lambda m: m["seconds"])
+            print(
+                f"{name:10} {best['seconds'] * 1000:9.1f} ms   resident +{mb(best['VmRSS'])} MB "
+                f"(anonymous +{mb(best['RssAnon'])} MB, file-backed +{mb(best['RssFile'])} MB)"
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_streamer(args) -> None:
+    size = FRAME_RATE * 12
+    chunks = [
+        np.random.default_rng(i).integers(-32768, 32767, 10240, dtype=np.int16).tobytes()
+        for i in range(args.chunks)
+    ]
+    signal_buffer = deque(maxlen=size)
+
+    def deque_callback() -> None:
+        for in_data in chunks:
+            signal_buffer.extend(struct.unpack(f"<{len(in_data) // 2}h", in_data))
+
+    ring_buffer = RingBuffer(size)
+
+    def ring_callback() -> None:
+        for in_data in chunks:
+            ring_buffer.write(np.frombuffer(in_data, dtype="<i2"))
+
+    deque_write, _ = timed(deque_callback, repeat=args.repeat)
+    ring_write, _ = timed(ring_callback, repeat=args.repeat)
+    deque_read, _ = timed(lambda: np.array(signal_buffer, dtype=np.int16), repeat=args.repeat)
+    ring_read, _ = timed(ring_buffer.read, repeat=args.repeat)
+    print(f"callback  deque {deque_write / args.chunks * 1e6:9.1f} us   ring {ring_write / args.chunks * 1e6:9.1f} us")
+    print(f"read      deque {deque_read * 1e6:9.1f} us   ring {ring_read * 1e6:9.1f} us")
+
+
+# The original filter: (b, a) designed on every pass and lfilter in float64
+# through apply_along_axis. It returned the result cast to int16.
+def bandpass_filter_reference(audio_signal: np.ndarray, lowcut=60.0, highcut=3000.0) -> np.ndarray:
+    nyq = 0.5 * FRAME_RATE
+    b, a = signal.butter(6, [lowcut / nyq, highcut / nyq], btype="band")
+    return np.apply_along_axis(lambda buffer: signal.lfilter(b, a, buffer), 0, audio_signal)
+
+
+def bench_filter(args) -> None:
+    bandpass_filter_sos = BandpassFilter(FRAME_RATE)
+    before_total, after_total, error, agree, signals = 0.0, 0.0, 0.0, 0, test_signals(args.signals)
+    for _, signal_array in signals:
+        before, expected = timed(
+            lambda: bandpass_filter_reference(signal_array).astype("int16"), repeat=args.repeat
+        )
+        after, result = timed(bandpass_filter_sos.process, signal_array, repeat=args.repeat)
+        before_total += before
+        after_total += after
+        reference = bandpass_filter_reference(signal_array)
+        error = max(error, np.abs(result - reference).max() / np.abs(reference).max())
+        agree += BpmAnalyzer.search_bpm(expected, FRAME_RATE).bpm_str == BpmAnalyzer.search_bpm(result, FRAME_RATE).bpm_str
+    print(f"signals:         {len(signals)}")
+    print(f"before:          {before_total / len(signals) * 1000:9.2f} ms/pass")
+    print(f"after:           {after_total / len(signals) * 1000:9.2f} ms/pass")
+    print(f"max rel. error:  {error:9.2e}")
+    print(f"same bpm:        {agree}/{len(signals)}")
+
+
+IMPORT_PATHS = {
+    "numpy": "",
+    "core": "import AnalyzerCore",
+    "core+first pass": """
+import AnalyzerCore
+AnalyzerCore.BpmAnalyzer.search_bpm(AnalyzerCore.bandpass_filter(np.zeros(AnalyzerCore.FRAME_RATE * 12)), AnalyzerCore.FRAME_RATE)
+""",
+    "app": "import BpmAnalizer",
+}
+
+
+def bench_import(args) -> None:
+    for name, code in IMPORT_PATHS.items():
+        script = f"""
+import json
+from time import perf_counter
+start = perf_counter()
+import numpy as np
+{code}
+print(json.dumps(perf_counter() - start))
+"""
+        timings = []
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+            if output.returncode:
+                break
+            timings.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        if timings:
+            print(f"{name:16} {min(timings) * 1000:9.1f} ms")
+        else:
+            print(f"{name:16} failed: {output.stderr.strip().splitlines()[-1]}")
+
+
+def bench_channels(args) -> None:
+    from MultiInput import Channel, MultiChannelAnalyzer
+
+    chunk = 10240
+    for count in args.counts:
+        channels = [Channel(index, FRAME_RATE) for index in range(count)]
+        tracks = [
+            click_track(110 + 7 * index, FRAME_RATE, seconds=12 + args.chunks * chunk / FRAME_RATE + 1, seed=index)
+            for index in range(count)
+        ]
+        buffer_updated = threading.Event()
+        analyzer = MultiChannelAnalyzer(channels, buffer_updated, args.workers)
+        threading.Thread(target=analyzer.run, daemon=True).start()
+        position = FRAME_RATE * 12
+        for channel, track in zip(channels, tracks):
+            channel.signal_buffer.write(track[:position])
+        for _ in range(args.chunks):
+            for channel, track in zip(channels, tracks):
+                channel.signal_buffer.write(track[position : position + chunk])
+            position += chunk
+            buffer_updated.set()
+            sleep(args.interval)
+        analyzer.stop()
+        latencies = np.concatenate([list(channel.latencies)[2:] for channel in channels]) * 1000
+        print(
+            f"{count} channels   latency median {np.median(latencies):7.1f} ms   "
+            f"p95 {np.percentile(latencies, 95):7.1f} ms   "
+            f"bpm {' '.join(channel.bpm_storage._str for channel in channels)}"
+        )
+
+
+class TimedScheduler(AnalysisScheduler):
+    # records how long ago the newest analyzed sample was written
+    def __init__(self, *args, write_times: dict, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_times = write_times
+        self.latencies = []
+
+    def analyze(self) -> BpmResult:
+        result = super().analyze()
+        self.latencies.append(perf_counter() - self.write_times[self.analyzed])
+        return result
+
+
+def run_on_every_callback(scheduler: AnalysisScheduler, stop_event: threading.Event) -> None:
+    # the original run_analyzer: one pass per audio callback, no rate control
+    while not stop_event.is_set():
+        scheduler.buffer_updated.wait()
+        scheduler.buffer_updated.clear()
+        result = scheduler.analyze()
+        scheduler.passes += 1
+        if result:
+            scheduler.publish(result.bpm)
+
+
+def bench_scheduler(args) -> None:
+    from AnalyzerCore import BpmStorage
+
+    track = click_track(124, FRAME_RATE, seconds=12 + args.seconds + 1)
+    BpmAnalyzer.search_bpm(bandpass_filter(track[: FRAME_RATE * 12]), FRAME_RATE)  # warm up
+    for hop in [None] + args.hops:
+        signal_buffer = RingBuffer(FRAME_RATE * 12)
+        buffer_updated, stop_event = threading.Event(), threading.Event()
+        write_times = {}
+        scheduler = TimedScheduler(
+            signal_buffer, buffer_updated, BpmStorage(), hop_seconds=hop or 0, write_times=write_times
+        )
+        position = FRAME_RATE * 12
+        signal_buffer.write(track[:position])
+        write_times[position] = perf_counter()
+        run = run_on_every_callback if hop is None else scheduler.run
+        thread = threading.Thread(target=run, args=(scheduler, stop_event) if hop is None else (stop_event,))
+        cpu_start = process_time()
+        thread.start()
+        interval = args.chunk / FRAME_RATE
+        deadline = perf_counter()
+        while position < FRAME_RATE * (12 + args.seconds):
+            deadline += interval
+            sleep(max(deadline - perf_counter(), 0))
+            signal_buffer.write(track[position : position + args.chunk])
+            position += args.chunk
+            write_times[position] = perf_counter()
+            buffer_updated.set()
+        stop_event.set()
+        buffer_updated.set()
+        thread.join()
+        cpu = (process_time() - cpu_start) / args.seconds
+        latencies = np.array(scheduler.latencies) * 1000
+        name = "every callback" if hop is None else f"hop {hop:g} s"
+        print(
+            f"{name:15} passes {scheduler.passes:4}   skipped {scheduler.skipped:4}   late {scheduler.late:4}   "
+            f"cpu {cpu * 100:5.1f} %   latency median {np.median(latencies):7.1f} ms   "
+            f"max {latencies.max():7.1f} ms   bpm {scheduler.bpm_storage._str}"
+        )
+
+
+def bench_midi(args) -> None:
+    # loopback through a virtual port: messages sent on the output port are
+    # read back on the input port, once by the old 20 ms polling loop and
+    # once by an rtmidi callback
+    import rtmidi
+
+    midi_out = rtmidi.MidiOut()
+    midi_out.open_virtual_port("bpm-benchmark")
+    midi_in = rtmidi.MidiIn()
+    midi_in.open_port(next(i for i, name in enumerate(midi_in.get_ports()) if "bpm-benchmark" in name))
+    message = [144, 60, 100]
+    mapping = tuple(message)
+    rng = np.random.default_rng(0)
+    for name in ("polling", "callback"):
+        sent, latencies = [0.0], []
+        received, stop_event = threading.Event(), threading.Event()
+
+        def trigger() -> None:
+            latencies.append(perf_counter() - sent[0])
+            received.set()
+
+        def poll() -> None:
+            while not stop_event.is_set():
+                sleep(0.02)
+                if (midi_in_msg := midi_in.get_message()) and tuple(midi_in_msg[0]) == mapping:
+                    trigger()
+
+        def on_message(event: tuple, data) -> None:
+            if tuple(event[0]) == mapping:
+                trigger()
+
+        if name == "polling":
+            threading.Thread(target=poll, daemon=True).start()
+        else:
+            midi_in.set_callback(on_message)
+        cpu_start = process_time()
+        for _ in range(args.messages):
+            sleep(rng.uniform(0.01, 0.1))
+            received.clear()
+            sent[0] = perf_counter()
+            midi_out.send_message(message)
+            received.wait(1)
+        cpu = process_time() - cpu_start
+        stop_event.set()
+        midi_in.cancel_callback()
+        latencies = np.array(latencies) * 1000
+        print(
+            f"{name:9} median {np.median(latencies):6.2f} ms   p95 {np.percentile(latencies, 95):6.2f} ms   "
+            f"max {latencies.max():6.2f} ms   cpu {cpu * 1000:6.1f} ms"
+        )
+    midi_in.close_port()
+    midi_out.close_port()
+
+
+def bench_clock(args) -> None:
+    # ticks are timestamped where they are sent, or with --loopback where they
+    # come back in through a virtual MIDI port; --load runs analysis passes on
+    # another thread meanwhile
+    from AnalyzerCore import BpmStorage
+    from MidiClock import TIMING_CLOCK, MidiClock
+
+    bpm_storage = BpmStorage()
+    BpmAnalyzer.store_bpm(bpm_storage, args.bpm)  # the clock starts with the first detected tempo
+    received = []
+    if args.loopback:
+        import rtmidi
+
+        midi_out = rtmidi.MidiOut()
+        midi_out.open_virtual_port("bpm-clock-benchmark")
+        midi_in = rtmidi.MidiIn()
+        midi_in.ignore_types(timing=False)
+        midi_in.open_port(next(i for i, name in enumerate(midi_in.get_ports()) if "bpm-clock-benchmark" in name))
+        midi_in.set_callback(lambda event, data: event[0][0] == TIMING_CLOCK and received.append(perf_counter()))
+        send = midi_out.send_message
+    else:
+        send = lambda message: message[0] == TIMING_CLOCK and received.append(perf_counter())
+    stop_load = threading.Event()
+
+    def load() -> None:
+        buffer = bandpass_filter(click_track(128, FRAME_RATE))
+        while not stop_load.is_set():
+            BpmAnalyzer.search_bpm(buffer, FRAME_RATE)
+
+    for _ in range(args.load):
+        threading.Thread(target=load, daemon=True).start()
+    midi_clock = MidiClock(send, bpm_storage, ramp_seconds=args.ramp)
+    midi_clock.start()
+    sleep(args.seconds / 2)
+    bpm_storage._float = args.bpm + args.change
+    sleep(args.seconds / 2)
+    midi_clock.stop()
+    stop_load.set()
+    if args.loopback:
+        sleep(0.1)
+        midi_in.close_port()
+        midi_out.close_port()
+
+    intervals = np.diff(received)
+    beats = np.diff(received[:: midi_clock.ppqn])
+    tempo = 60 / beats
+    steady = intervals[: len(intervals) // 2 - midi_clock.ppqn]
+    error = (steady - 60 / (args.bpm * midi_clock.ppqn)) * 1000
+    print(json.dumps(midi_clock.jitter_stats()))
+    print(
+        f"ticks {len(received)}   interval error median {np.median(np.abs(error)):.3f} ms   "
+        f"p99 {np.percentile(np.abs(error), 99):.3f} ms   max {np.abs(error).max():.3f} ms"
+    )
+    print(
+        f"tempo {tempo[0]:.2f} -> {tempo[-1]:.2f} BPM   "
+        f"largest beat to beat change {np.abs(np.diff(tempo)).max():.3f} BPM"
+    )
+
+
+def set_bpm_reference(link_session: object, bpm: float) -> None:
+    # the original AbletonLink.set_bpm, run on the caller's thread
+    for value in [0.001, -0.001]:
+        bpm += value
+        s = link_session.captureSessionState()
+        link_time = link_session.clock().micros()
+        s.setTempo(bpm, link_time)
+        link_session.commitSessionState(s)
+        sleep(0.03)
+
+
+def bench_link(args) -> None:
+    import link
+
+    from LinkPublisher import LinkPublisher
+
+    class CountingPublisher(LinkPublisher):
+        def publish(self, bpm: float, enqueued: float) -> None:
+            self.commits = getattr(self, "commits", 0) + 1
+            super().publish(bpm, enqueued)
+
+    link_session = link.Link(120.0)
+    link_session.enabled = True
+    blocked, _ = timed(set_bpm_reference, link_session, 125.0, repeat=args.repeat)
+    print(f"set_bpm   caller blocked {blocked * 1000:8.3f} ms   (original)")
+
+    publisher = CountingPublisher(link_session)
+    blocked, _ = timed(publisher.set_bpm, 125.0, repeat=args.repeat)
+    sleep(0.2)
+    print(f"set_bpm   caller blocked {blocked * 1000:8.3f} ms   (publisher)")
+
+    start = perf_counter()
+    for index in range(args.burst):
+        publisher.set_bpm(120.0 + index * 0.01)
+    enqueue = perf_counter() - start
+    sleep(0.5)
+    print(
+        f"burst     {args.burst} calls in {enqueue * 1000:.3f} ms -> {publisher.commits} commits, "
+        f"session tempo {link_session.captureSessionState().tempo():.2f}"
+    )
+    publisher.stop()
+
+    # analyzer results every 100 ms: jitter below the delta, then a tempo change
+    publisher = CountingPublisher(link_session, auto_follow=True, follow_delta=args.delta, follow_interval=args.interval)
+    rng = np.random.default_rng(0)
+    for index in range(args.results):
+        bpm = (124.0 if index < args.results // 2 else 128.0) + rng.uniform(-args.delta / 3, args.delta / 3)
+        publisher.follow(round(bpm, 2))
+        sleep(0.1)
+    sleep(args.interval)
+    latencies = np.array(publisher.publish_latencies) * 1000
+    print(
+        f"follow    {args.results} results -> {publisher.commits} commits, "
+        f"session tempo {link_session.captureSessionState().tempo():.2f}   "
+        f"publish latency median {np.median(latencies):.2f} ms   max {latencies.max():.2f} ms"
+    )
+    publisher.stop()
+    link_session.enabled = False
+
+
+def bench_phase(args) -> None:
+    # beat phase at the end of the buffer against the phase the click track
+    # was built with, for results within 0.5 BPM of the true tempo
+    rng = np.random.default_rng(args.seed)
+    errors, wrong_tempo = [], 0
+    for index in range(args.signals):
+        bpm, phase = rng.uniform(101, 159), rng.uniform()
+        signal_array = click_track(bpm, FRAME_RATE, phase=phase, noise=rng.uniform(0.01, 0.3), seed=index)
+        if not (result := BpmAnalyzer.search_bpm(bandpass_filter(signal_array), FRAME_RATE)):
+            continue
+        if abs(result.bpm - bpm) > 0.5:
+            wrong_tempo += 1
+            continue
+        period = 60 / bpm * FRAME_RATE
+        expected = (signal_array.size - phase * period) % period / period
+        errors.append(((result.beat_phase - expected + 0.5) % 1 - 0.5) * 60 / bpm * 1000)
+    errors = np.array(errors)
+    print(
+        f"{errors.size} of {args.signals} signals   phase error median {np.median(np.abs(errors)):.1f} ms   "
+        f"p95 {np.percentile(np.abs(errors), 95):.1f} ms   bias {errors.mean():+.1f} ms   "
+        f"({wrong_tempo} off tempo skipped)"
+    )
+
+
+def moving_average_reference(estimates: list) -> list:
+    # the original store_bpm: plain mean of the last three accepted results
+    average_window, tracked = deque(maxlen=3), []
+    for bpm, _ in estimates:
+        if bpm is not None:
+            average_window.append(bpm)
+        tracked.append(sum(average_window) / len(average_window) if average_window else None)
+    return tracked
+
+
+def synthetic_estimates(passes: int, seed=0) -> tuple:
+    # step changes in tempo, small jitter, 8 % octave errors (random tempos where
+    # the octave is out of range) and 10 % rejected passes
+    rng = np.random.default_rng(seed)
+    truth = np.repeat([124.0, 128.0, 126.5, 118.0, 118.5], passes // 5)
+    estimates = []
+    for bpm in truth:
+        draw = rng.uniform()
+        if draw < 0.1:
+            estimates.append((None, 0.0))
+        elif draw < 0.18:
+            wrong = bpm * rng.choice([1.5, 2 / 3])
+            wrong = wrong if MIN_BPM <= wrong < MAX_BPM else rng.uniform(MIN_BPM, MAX_BPM)
+            estimates.append((round(wrong, 2), rng.uniform(0.25, 0.5)))
+        else:
+            estimates.append((round(bpm + rng.normal(0, 0.05), 2), rng.uniform(0.6, 0.95)))
+    return truth.tolist(), estimates
+
+
+def record_estimates(path: str, hop_seconds: float) -> list:
+    from BpmBatch import read_windows
+
+    estimates = []
+    for window in read_windows(path, FRAME_RATE, 12.0, hop_seconds):
+        result = BpmAnalyzer.search_bpm(bandpass_filter(window), FRAME_RATE)
+        estimates.append((result.bpm, result.confidence) if result else (None, 0.0))
+    return estimates
+
+
+def tracking_report(name: str, tracked: list, truth: list) -> None:
+    tracked = np.array([np.nan if bpm is None else bpm for bpm in tracked])
+    changes = int(np.count_nonzero(np.diff(np.round(tracked, 2))[~np.isnan(np.diff(tracked))]))
+    line = f"{name:15} displayed changes {changes:4}"
+    if truth:
+        truth = np.array(truth)
+        error = np.abs(tracked - truth)
+        steps = np.flatnonzero(np.diff(truth)) + 1
+        settle = []
+        for step, end in zip(steps, list(steps[1:]) + [truth.size]):
+            off = np.flatnonzero(~(error[step:end] <= 0.25))
+            settle.append(0 if not off.size else int(off[-1]) + 1)
+        stable = np.ones(truth.size, dtype=bool)
+        for step in steps:
+            stable[step : step + max(settle)] = False
+        line += (
+            f"   settle passes {' '.join(map(str, settle))}   "
+            f"stable error median {np.nanmedian(error[stable]):.3f} BPM   "
+            f"off by > 2 BPM {int(np.count_nonzero(error > 2))} passes"
+        )
+    print(line)
+
+
+def bench_tracker(args) -> None:
+    from AnalyzerCore import TempoTracker
+
+    truth = []
+    if args.record:
+        estimates = record_estimates(args.record, args.hop)
+    elif args.estimates:
+        with open(args.estimates, "r") as recorded:
+            data = json.load(recorded)
+        estimates, truth = [tuple(estimate) for estimate in data["estimates"]], data.get("truth", [])
+    else:
+        truth, estimates = synthetic_estimates(args.passes, args.seed)
+    if args.save:
+        with open(args.save, "w") as recorded:
+            json.dump({"estimates": estimates, "truth": truth}, recorded)
+    print(f"{len(estimates)} passes, {sum(bpm is None for bpm, _ in estimates)} rejected")
+    tracking_report("3-pass average", moving_average_reference(estimates), truth)
+    tracking_report("tracker", TempoTracker.replay(estimates), truth)
+
+
+# The original detector: a Python loop over half-second windows that
+# binarizes each window in place.
+def search_beat_events_reference(signal_array: np.ndarray, frame_rate: int) -> np.ndarray:
+    step_size = frame_rate // 2
+    events = []
+    for step_start in range(0, len(signal_array), step_size):
+        signal_array_window = signal_array[step_start : step_start + step_size]
+        signal_array_window[signal_array_window < signal_array_window.max()] = 0
+        signal_array_window[signal_array_window > 0] = 1
+        event = np.argmax(signal_array_window) + step_start
+        events.append(event)
+    return np.array(events, dtype=np.int64)
+
+
+def bench_onsets(args) -> None:
+    signals = [(bpm, bandpass_filter(signal_array)) for bpm, signal_array in test_signals(args.signals, args.seed)]
+    buffer = signals[0][1]
+    reference, _ = timed(lambda: search_beat_events_reference(buffer.copy(), FRAME_RATE), repeat=args.repeat)
+    window, _ = timed(BpmAnalyzer.search_beat_events, buffer, FRAME_RATE, repeat=args.repeat)
+    onsets, _ = timed(BpmAnalyzer.search_onsets, buffer, FRAME_RATE, repeat=args.repeat)
+    same = sum(
+        np.array_equal(
+            search_beat_events_reference(filtered.copy(), FRAME_RATE),
+            BpmAnalyzer.search_beat_events(filtered, FRAME_RATE),
+        )
+        for _, filtered in signals
+    )
+    print(f"original loop   {reference * 1000:7.3f} ms/pass")
+    print(f"window          {window * 1000:7.3f} ms/pass   same events {same}/{len(signals)}")
+    print(f"onsets          {onsets * 1000:7.3f} ms/pass")
+    for name, detector in [
+        ("window", BpmAnalyzer.search_beat_events),
+        ("onsets", lambda filtered, frame_rate: BpmAnalyzer.search_onsets(filtered, frame_rate)[0]),
+    ]:
+        accepted = correct = events = 0
+        for bpm, filtered in signals:
+            beat_events = detector(filtered, FRAME_RATE)
+            events += beat_events.size / (len(filtered) / FRAME_RATE * bpm / 60)
+            if result := BpmAnalyzer.search_bpm_in_events(beat_events, len(filtered)):
+                accepted += 1
+                correct += abs(result.bpm - bpm) < 0.5
+        print(
+            f"{name:15} accepted {accepted}/{len(signals)}   within 0.5 BPM {correct}   "
+            f"events per beat {events / len(signals):.2f}"
+        )
+
+
+def tempo_corpus(paths: list) -> list:
+    # audio files with their tempo in the name, e.g. "kick_128.5bpm.wav"
+    from BpmBatch import find_audio_files, read_windows
+
+    corpus = []
+    for path in find_audio_files(paths):
+        if match := re.search(r"(\d+(?:\.\d+)?)\s*bpm", path, re.IGNORECASE):
+            window = next(read_windows(path, FRAME_RATE, 12.0, 12.0), None)
+            if window is not None:
+                corpus.append((float(match[1]), window))
+    return corpus
+
+
+def bench_multirate(args) -> None:
+    import AnalyzerCore
+
+    corpus = tempo_corpus(args.paths) if args.paths else test_signals(args.signals, args.seed)
+    signals = [(bpm, bandpass_filter(signal_array)) for bpm, signal_array in corpus]
+    coarse = BpmAnalyzer.coarse_pattern_matcher()
+    decimated = BpmAnalyzer.decimated_pattern_matcher()
+    print(f"{len(signals)} signals")
+    for name, matcher in [("full rate", coarse), ("multi-rate", decimated)]:
+        table_bytes = matcher.timestamps.nbytes + matcher.flat_index.nbytes
+        print(f"{name:12} coarse table {matcher.timestamps.size:9} entries {table_bytes / 2**20:6.2f} MiB")
+    for name, multi_rate in [("full rate", False), ("multi-rate", True)]:
+        AnalyzerCore.MULTI_RATE = multi_rate
+        seconds, _ = timed(BpmAnalyzer.search_bpm, signals[0][1], FRAME_RATE, repeat=args.repeat)
+        errors = []
+        for bpm, filtered in signals:
+            if result := BpmAnalyzer.search_bpm(filtered, FRAME_RATE):
+                errors.append(abs(result.bpm - bpm))
+        errors = np.array(errors)
+        print(
+            f"{name:12} accepted {errors.size}/{len(signals)}   "
+            f"within 0.10 BPM {int(np.count_nonzero(errors <= 0.1))}   "
+            f"mean error {errors.mean() if errors.size else float('nan'):.3f} BPM   "
+            f"{seconds * 1000:6.1f} ms/pass"
+        )
+    AnalyzerCore.MULTI_RATE = False
+
+
+def bench_engines(args) -> None:
+    from AnalyzerCore import TEMPO_ENGINES
+
+    corpus = tempo_corpus(args.paths) if args.paths else test_signals(args.signals, args.seed)
+    signals = [(bpm, bandpass_filter(signal_array)) for bpm, signal_array in corpus]
+    print(f"{len(signals)} signals")
+    for name in TEMPO_ENGINES:
+        engine = tempo_engine(name)
+        engine.search_bpm(signals[0][1], FRAME_RATE)  # warm up, builds the voting patterns
+        for path, search in [
+            ("buffer", lambda filtered: engine.search_bpm(filtered, FRAME_RATE)),
+            (
+                "events",
+                lambda filtered: engine.search_bpm_in_events(
+                    BpmAnalyzer.search_beat_events(filtered, FRAME_RATE), len(filtered)
+                ),
+            ),
+        ]:
+            errors = []
+            cpu = process_time()
+            for bpm, filtered in signals:
+                if result := search(filtered):
+                    errors.append(abs(result.bpm - bpm))
+            cpu = (process_time() - cpu) / len(signals)
+            errors = np.array(errors)
+            print(
+                f"{name:15} {path:6} {cpu * 1000:6.2f} ms CPU/pass   accepted {errors.size}/{len(signals)}   "
+                f"within 0.10 BPM {int(np.count_nonzero(errors <= 0.1))}   "
+                f"within 0.5 BPM {int(np.count_nonzero(errors <= 0.5))}   "
+                f"median error {np.median(errors) if errors.size else float('nan'):.3f} BPM"
+            )
+
+
+ACCURACY_SIGNALS = ["click", "drums", "swing"]
+ACCURACY_DEGRADATIONS = ["clean", "noise", "dropouts", "mic"]
+
+
+def accuracy_signal(kind: str, bpm: float, phase: float, seed: int) -> np.ndarray:
+    if kind == "click":
+        return click_track(bpm, FRAME_RATE, phase=phase, noise=0.01, seed=seed)
+    return drum_loop(bpm, FRAME_RATE, phase=phase, swing=0.33 if kind == "swing" else 0.0, seed=seed)
+
+
+def voting_stages(filtered: np.ndarray) -> dict:
+    # seconds spent in each stage of the voting engine, one pass
+    seconds = {}
+    start = perf_counter()
+    beat_events = BpmAnalyzer.search_beat_events(filtered, FRAME_RATE)
+    seconds["search_beat_events"] = perf_counter() - start
+    start = perf_counter()
+    bpm_container = BpmAnalyzer.bpm_container(beat_events, BpmAnalyzer.coarse_pattern_matcher(), len(BPM_PATTERN))
+    bpm_container_final = finalised(bpm_container)
+    seconds["coarse"] = perf_counter() - start
+    if bpm_container_final is not None:
+        start = perf_counter()
+        bpm_wrapped = BpmAnalyzer.get_bpm_wrapped(bpm_container_final)
+        start_row, end_row = BpmAnalyzer.get_bpm_pattern_fine_window(bpm_wrapped)
+        pattern_matcher = BpmAnalyzer.fine_pattern_matcher(start_row, end_row)
+        finalised(BpmAnalyzer.bpm_container(beat_events, pattern_matcher, end_row - start_row))
+        seconds["fine"] = perf_counter() - start
+    return seconds
+
+
+def accuracy_metrics(errors: list, rejected: Counter, count: int) -> dict:
+    errors = np.array(errors)
+    accepted = errors.size
+    metrics = {
+        "signals": count,
+        "accepted": accepted,
+        "rejection_rate": round(1 - accepted / count, 4) if count else None,
+        "within_0.10": int(np.count_nonzero(errors <= 0.1)),
+        "within_0.10_rate": round(int(np.count_nonzero(errors <= 0.1)) / count, 4) if count else None,
+        "median_error": round(float(np.median(errors)), 4) if accepted else None,
+        "p95_error": round(float(np.percentile(errors, 95)), 4) if accepted else None,
+        "rejections": dict(rejected),
+    }
+    return metrics
+
+
+def stage_summary(seconds: list) -> dict:
+    milliseconds = np.array(seconds) * 1000
+    return {
+        "passes": int(milliseconds.size),
+        "mean_ms": round(float(milliseconds.mean()), 4),
+        "median_ms": round(float(np.median(milliseconds)), 4),
+        "p95_ms": round(float(np.percentile(milliseconds, 95)), 4),
+    }
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_accuracy(report: dict, baseline: dict, tolerance: float) -> int:
+    # prints the changes against a previous report; returns the number of
+    # scenarios whose rate within 0.10 BPM dropped by more than tolerance
+    regressions = 0
+    print(f"\nagainst {baseline.get('version') or 'baseline'}")
+    for name, metrics in report["scenarios"].items():
+        if name not in baseline["scenarios"]:
+            continue
+        before, after = baseline["scenarios"][name]["within_0.10_rate"], metrics["within_0.10_rate"]
+        regressed = before - after > tolerance
+        regressions += regressed
+        print(f"{name:18} within 0.10 BPM {before:6.1%} -> {after:6.1%}{'   REGRESSION' if regressed else ''}")
+    for name, stage in report["stages"].items():
+        if name in baseline["stages"]:
+            print(f"{name:18} median {baseline['stages'][name]['median_ms']:8.3f} -> {stage['median_ms']:8.3f} ms")
+    return regressions
+
+
+def bench_accuracy(args) -> None:
+    import AnalyzerCore
+
+    engine = tempo_engine(args.engine)
+    rng = np.random.default_rng(args.seed)
+    # one tempo from every slice of the range, so the whole range is covered
+    edges = np.linspace(MIN_BPM, MAX_BPM, args.tempos + 1)
+    tempos = [(round(float(rng.uniform(low, high)), 2), float(rng.uniform())) for low, high in zip(edges, edges[1:])]
+    stages = {"bandpass_filter": [], "search_beat_events": [], "coarse": [], "fine": [], "search_bpm": []}
+    scenarios = {}
+    all_errors, all_rejected, count = [], Counter(), 0
+    engine.search_bpm(BANDPASS_FILTER.process(np.zeros(FRAME_RATE * 12, dtype=np.int16)), FRAME_RATE)  # warm up
+    for kind in ACCURACY_SIGNALS:
+        for degradation in ACCURACY_DEGRADATIONS:
+            errors, rejected = [], Counter()
+            for index, (bpm, phase) in enumerate(tempos):
+                seed = args.seed + index
+                signal_array = degrade(accuracy_signal(kind, bpm, phase, seed), FRAME_RATE, degradation, seed)
+                start = perf_counter()
+                filtered = BANDPASS_FILTER.process(signal_array)
+                stages["bandpass_filter"].append(perf_counter() - start)
+                start = perf_counter()
+                result = engine.search_bpm(filtered, FRAME_RATE)
+                stages["search_bpm"].append(perf_counter() - start)
+                if engine is BpmAnalyzer:
+                    # after search_bpm, so the fine windows it built are cached
+                    for name, seconds in voting_stages(filtered).items():
+                        stages[name].append(seconds)
+                if result:
+                    errors.append(abs(result.bpm - bpm))
+                else:
+                    rejected[result.rejected] += 1
+            scenarios[f"{kind}/{degradation}"] = accuracy_metrics(errors, rejected, len(tempos))
+            all_errors += errors
+            all_rejected += rejected
+            count += len(tempos)
+    report = {
+        "version": git_version(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "settings": {
+            "engine": args.engine or AnalyzerCore.TEMPO_ENGINE,
+            "frame_rate": FRAME_RATE,
+            "min_bpm": MIN_BPM,
+            "max_bpm": MAX_BPM,
+            "onset_detector": AnalyzerCore.ONSET_DETECTOR,
+            "multi_rate": AnalyzerCore.MULTI_RATE,
+            "tempos": args.tempos,
+            "seed": args.seed,
+        },
+        "stages": {name: stage_summary(seconds) for name, seconds in stages.items() if seconds},
+        "scenarios": scenarios,
+        "overall": accuracy_metrics(all_errors, all_rejected, count),
+    }
+    for name, metrics in [*scenarios.items(), ("overall", report["overall"])]:
+        median = "   ---" if metrics["median_error"] is None else f"{metrics['median_error']:6.3f}"
+        print(
+            f"{name:18} within 0.10 BPM {metrics['within_0.10']:4}/{metrics['signals']:<4} "
+            f"rejected {metrics['rejection_rate']:6.1%}   median error {median} BPM"
+        )
+    for name, stage in report["stages"].items():
+        print(f"{name:18} median {stage['median_ms']:8.3f} ms   p95 {stage['p95_ms']:8.3f} ms")
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as previous:
+            if compare_accuracy(report, json.load(previous), args.tolerance):
+                sys.exit(1)
+
+
+def bench_metrics(args) -> None:
+    import timeit
+    from urllib.request import urlopen
+
+    import Metrics
+    from AnalyzerCore import BpmStorage
+
+    track = click_track(124, FRAME_RATE, seconds=12 + args.passes + 1)
+    signal_buffer = RingBuffer(FRAME_RATE * 12)
+    signal_buffer.write(track[: FRAME_RATE * 12])
+    schedulers = {}
+    for name in ["disabled", "enabled"]:
+        if name == "enabled":
+            Metrics.enable()
+        schedulers[name] = AnalysisScheduler(signal_buffer, threading.Event(), BpmStorage())
+    schedulers["enabled"].analyze()  # warm up
+    seconds = {"disabled": [], "enabled": []}
+    position = FRAME_RATE * 12
+    for _ in range(args.passes):
+        signal_buffer.write(track[position : position + FRAME_RATE // 2])
+        position += FRAME_RATE // 2
+        # alternating, so both see the same load on a noisy machine
+        for name, metrics in [("disabled", None), ("enabled", Metrics.enable())]:
+            Metrics.METRICS = metrics
+            scheduler = schedulers[name]
+            start = perf_counter()
+            if Metrics.METRICS is not None:
+                scheduler.observe_buffer(Metrics.METRICS)
+            result = scheduler.analyze()
+            if Metrics.METRICS is not None:
+                scheduler.observe_pass(Metrics.METRICS, perf_counter() - start, result)
+            seconds[name].append(perf_counter() - start)
+    for name, values in seconds.items():
+        print(f"{name:9} pass median {np.median(values) * 1000:7.3f} ms   mean {np.mean(values) * 1000:7.3f} ms")
+    metrics = Metrics.enable()
+    check = timeit.timeit("Metrics.METRICS is not None", globals={"Metrics": Metrics}, number=100000) / 100000
+    observe = timeit.timeit(
+        "scratch.observe('analysis_stage_seconds', 0.003, stage='coarse')",
+        globals={"scratch": Metrics.Metrics()},
+        number=100000,
+    ) / 100000
+    print(f"disabled check {check * 1e9:6.1f} ns   observe {observe * 1e9:6.1f} ns")
+    server = Metrics.MetricsServer(metrics, port=0)
+    server.start()
+    for path in ["/metrics", "/metrics.json"]:
+        start = perf_counter()
+        with urlopen(f"http://127.0.0.1:{server.port}{path}") as response:
+            body = response.read()
+        print(f"{path:14} {len(body):6} bytes in {(perf_counter() - start) * 1000:6.2f} ms")
+    server.stop()
+    if args.show:
+        print(metrics.prometheus())
+    Metrics.disable()
+
+
+def bench_replay(args) -> None:
+    import os
+    import tempfile
+
+    from Recording import Recorder, replay
+
+    track = np.concatenate(
+        [click_track(bpm, FRAME_RATE, seconds=args.seconds / 3, seed=i) for i, bpm in enumerate([122, 128.5, 140])]
+    )
+    path = os.path.join(tempfile.mkdtemp(), "show.wav")
+    # a recorder half the size of the show, so it wraps around
+    recorder = Recorder(path, FRAME_RATE, max_seconds=args.seconds / 2)
+    writes = []
+    for start in range(0, track.size, 10240):
+        begin = perf_counter()
+        recorder.write(track[start : start + 10240])
+        writes.append(perf_counter() - begin)
+    recorder.close()
+    writes = np.array(writes) * 1e6
+    print(
+        f"recorder       {len(writes)} callbacks   median {np.median(writes):6.1f} us   max {writes.max():7.1f} us   "
+        f"file {os.path.getsize(path) / 2**20:.1f} MiB"
+    )
+    runs = [replay(path) for _ in range(2)]
+    print(
+        f"replay         {runs[0]['audio_seconds']:.0f} s of audio in {runs[0]['wall_seconds']:.2f} s "
+        f"({runs[0]['speed']:.1f}x real time)   passes {runs[0]['passes']}   "
+        f"same timeline twice {runs[0]['timeline'] == runs[1]['timeline']}"
+    )
+    os.remove(path)
+
+
+async def websocket_subscriber(port: int, latencies: list, stalled=False) -> None:
+    # a minimal client: handshake, then read frames and note the tempo latency;
+    # a stalled client never reads after the handshake
+    import base64
+    import os
+    import socket
+
+    from TempoServer import read_websocket_frame
+
+    sock = socket.socket()
+    if stalled:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write(
+        f"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode()
+    )
+    await reader.readuntil(b"\r\n\r\n")
+    try:
+        if stalled:
+            writer.transport.pause_reading()
+            await asyncio.sleep(3600)
+        while True:
+            _, payload = await read_websocket_frame(reader)
+            message = json.loads(payload)
+            if message["type"] == "tempo":
+                latencies.append(time.time() - message["time"])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.transport.abort()
+
+
+class OscSubscriber(asyncio.DatagramProtocol):
+    def __init__(self, sent: dict, latencies: list):
+        self.sent = sent
+        self.latencies = latencies
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        if data.startswith(b"/bpm/tempo"):
+            bpm = struct.unpack(">f", data[-8:-4])[0]
+            if (sent := self.sent.get(round(bpm, 2))) is not None:
+                self.latencies.append(time.time() - sent)
+
+
+def bench_broadcast(args) -> None:
+    from TempoServer import TempoServer, osc_message
+
+    server = TempoServer(osc_port=0, websocket_port=0, host="127.0.0.1", slow_client_seconds=args.slow_seconds)
+    server.start()
+    sent = {}
+    latencies = {"websocket": [], "osc": []}
+
+    def publish() -> None:
+        # from another thread, as the analyzer does
+        for update in range(args.updates):
+            bpm = round(100 + update * 0.05, 2)
+            sent[bpm] = time.time()
+            server.publish_tempo(bpm, format(bpm, ".2f"))
+            sleep(args.interval)
+
+    async def load() -> None:
+        loop = asyncio.get_running_loop()
+        stalled = [
+            loop.create_task(websocket_subscriber(server.websocket_port, [], stalled=True)) for _ in range(args.stalled)
+        ]
+        tasks = [
+            loop.create_task(websocket_subscriber(server.websocket_port, latencies["websocket"]))
+            for _ in range(args.websocket)
+        ]
+        transports = []
+        for _ in range(args.osc):
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: OscSubscriber(sent, latencies["osc"]), local_addr=("127.0.0.1", 0)
+            )
+            transports.append(transport)
+        deadline = perf_counter() + 10
+        while len(server.clients) < args.websocket + args.stalled + args.osc and perf_counter() < deadline:
+            # datagrams may be dropped, subscribing again is harmless
+            for transport in transports:
+                transport.sendto(osc_message("/bpm/subscribe"), ("127.0.0.1", server.osc_port))
+            await asyncio.sleep(0.2)
+        subscribed = len(server.clients)
+        cpu = process_time()
+        await loop.run_in_executor(None, publish)
+        await asyncio.sleep(args.slow_seconds + 0.5)
+        cpu = process_time() - cpu
+        coalesced = sum(client.coalesced for client in list(server.clients))
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for transport in transports:
+            transport.sendto(osc_message("/bpm/unsubscribe"), ("127.0.0.1", server.osc_port))
+        # a burst only the stalled clients get, enough to fill their buffers
+        for update in range(args.burst):
+            server.publish_tempo(200.0, "200.00")
+            await asyncio.sleep(0.0005)
+        await asyncio.sleep(args.slow_seconds + 0.5)
+        for task in stalled:
+            task.cancel()
+        await asyncio.gather(*stalled, return_exceptions=True)
+        for transport in transports:
+            transport.close()
+        return subscribed, cpu, coalesced
+
+    subscribed, cpu, coalesced = asyncio.run(load())
+    server.stop()
+    print(
+        f"{args.websocket} WebSocket + {args.osc} OSC subscribers, {args.stalled} stalled, "
+        f"{args.updates} updates every {args.interval * 1000:g} ms, {subscribed} subscribed"
+    )
+    for name, values in latencies.items():
+        subscribers = args.websocket if name == "websocket" else args.osc
+        if not values:
+            print(f"{name:10} nothing received")
+            continue
+        values = np.array(values) * 1000
+        print(
+            f"{name:10} received {values.size}/{subscribers * args.updates}   latency median {np.median(values):6.2f} ms   "
+            f"p99 {np.percentile(values, 99):6.2f} ms   max {values.max():6.2f} ms"
+        )
+    print(f"coalesced {coalesced}   cpu {cpu:.2f} s   stalled clients dropped {server.disconnected}/{args.stalled}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Live BPM Analyzer benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    voting = subparsers.add_parser("voting", help="original voting pipeline vs sorted index and vote matrix")
+    voting.add_argument("--signals", type=int, default=10)
+    voting.add_argument("--buffers", help=".npy file of recorded int16 buffers to replay")
+    voting.add_argument("--repeat", type=int, default=3)
+    voting.set_defaults(run=bench_voting)
+    startup = subparsers.add_parser("startup", help="pattern startup time and resident memory")
+    startup.add_argument("--paths", nargs="+", choices=STARTUP_PATHS, default=list(STARTUP_PATHS))
+    startup.add_argument("--repeat", type=int, default=3)
+    startup.set_defaults(run=bench_startup)
+    import_ = subparsers.add_parser("import", help="cold import time of the analyzer core and the app")
+    import_.add_argument("--repeat", type=int, default=5)
+    import_.set_defaults(run=bench_import)
+    channels = subparsers.add_parser("channels", help="per-channel latency of the multi-input analyzer")
+    channels.add_argument("--counts", type=int, nargs="+", default=[1, 2, 4, 8])
+    channels.add_argument("--chunks", type=int, default=20)
+    channels.add_argument("--interval", type=float, default=0.25, help="seconds between audio chunks")
+    channels.add_argument("--workers", type=int)
+    channels.set_defaults(run=bench_channels)
+    scheduler = subparsers.add_parser("scheduler", help="analysis on every audio callback vs the hop scheduler")
+    scheduler.add_argument("--seconds", type=float, default=10.0, help="seconds of live audio to simulate")
+    scheduler.add_argument("--chunk", type=int, default=1024, help="frames per audio callback")
+    scheduler.add_argument("--hops", type=float, nargs="+", default=[0.25, 0.5, 1.0])
+    scheduler.set_defaults(run=bench_scheduler)
+    midi = subparsers.add_parser("midi", help="MIDI trigger latency, 20 ms polling vs rtmidi callback")
+    midi.add_argument("--messages", type=int, default=200)
+    midi.set_defaults(run=bench_midi)
+    clock = subparsers.add_parser("clock", help="MIDI clock jitter, drift and tempo ramp")
+    clock.add_argument("--seconds", type=float, default=10.0)
+    clock.add_argument("--bpm", type=float, default=120.0)
+    clock.add_argument("--change", type=float, default=8.0, help="tempo change halfway through")
+    clock.add_argument("--ramp", type=float, default=1.0, help="ramp time of the tempo change in seconds")
+    clock.add_argument("--load", type=int, default=0, help="threads running analysis passes meanwhile")
+    clock.add_argument("--loopback", action="store_true", help="measure through a virtual MIDI port")
+    clock.set_defaults(run=bench_clock)
+    link_ = subparsers.add_parser("link", help="Link tempo publishing, caller blocking, coalescing and auto-follow")
+    link_.add_argument("--repeat", type=int, default=5)
+    link_.add_argument("--burst", type=int, default=100)
+    link_.add_argument("--results", type=int, default=40, help="analyzer results fed to auto-follow")
+    link_.add_argument("--delta", type=float, default=0.05)
+    link_.add_argument("--interval", type=float, default=1.0)
+    link_.set_defaults(run=bench_link)
+    phase = subparsers.add_parser("phase", help="beat phase accuracy on click tracks")
+    phase.add_argument("--signals", type=int, default=40)
+    phase.add_argument("--seed", type=int, default=1)
+    phase.set_defaults(run=bench_phase)
+    tracker = subparsers.add_parser("tracker", help="replay estimate sequences through the 3-pass average and the tempo tracker")
+    tracker.add_argument("--estimates", help="JSON file with recorded estimates (and optionally the true tempo)")
+    tracker.add_argument("--record", help="audio file to analyze into an estimate sequence")
+    tracker.add_argument("--hop", type=float, default=0.5, help="seconds between passes when recording")
+    tracker.add_argument("--save", help="write the estimate sequence to this JSON file")
+    tracker.add_argument("--passes", type=int, default=300)
+    tracker.add_argument("--seed", type=int, default=0)
+    tracker.set_defaults(run=bench_tracker)
+    onsets = subparsers.add_parser("onsets", help="original vs vectorized beat events, and the onset detector")
+    onsets.add_argument("--signals", type=int, default=40)
+    onsets.add_argument("--seed", type=int, default=0)
+    onsets.add_argument("--repeat", type=int, default=20)
+    onsets.set_defaults(run=bench_onsets)
+    streamer = subparsers.add_parser("streamer", help="deque + struct.unpack vs ring buffer")
+    streamer.add_argument("--chunks", type=int, default=64)
+    streamer.add_argument("--repeat", type=int, default=5)
+    streamer.set_defaults(run=bench_streamer)
+    filter_ = subparsers.add_parser("filter", help="per-pass (b, a) lfilter vs cached float32 sosfilt")
+    filter_.add_argument("--signals", type=int, default=10)
+    filter_.add_argument("--repeat", type=int, default=5)
+    filter_.set_defaults(run=bench_filter)
+    multirate = subparsers.add_parser("multirate", help="full rate matching vs the decimated multi-rate path")
+    multirate.add_argument("paths", nargs="*", help="audio files or directories with the tempo in the name")
+    multirate.add_argument("--signals", type=int, default=100)
+    multirate.add_argument("--seed", type=int, default=0)
+    multirate.add_argument("--repeat", type=int, default=5)
+    multirate.set_defaults(run=bench_multirate)
+    engines = subparsers.add_parser("engines", help="CPU per pass and accuracy of every tempo engine")
+    engines.add_argument("paths", nargs="*", help="audio files or directories with the tempo in the name")
+    engines.add_argument("--signals", type=int, default=100)
+    engines.add_argument("--seed", type=int, default=0)
+    engines.set_defaults(run=bench_engines)
+    accuracy = subparsers.add_parser("accuracy", help="stage timings, error and rejection rate on degraded signals")
+    accuracy.add_argument("--tempos", type=int, default=30, help="tempos per signal and degradation")
+    accuracy.add_argument("--seed", type=int, default=0)
+    accuracy.add_argument("--engine", help="tempo engine, defaults to TEMPO_ENGINE in AnalyzerCore.py")
+    accuracy.add_argument("--json", help="write the report to this file")
+    accuracy.add_argument("--baseline", help="compare with an earlier report, exit 1 on a regression")
+    accuracy.add_argument("--tolerance", type=float, default=0.02, help="allowed drop of the rate within 0.10 BPM")
+    accuracy.set_defaults(run=bench_accuracy)
+    metrics = subparsers.add_parser("metrics", help="analysis pass time with metrics disabled and enabled, endpoint scrape")
+    metrics.add_argument("--passes", type=int, default=40)
+    metrics.add_argument("--show", action="store_true", help="print the Prometheus text")
+    metrics.set_defaults(run=bench_metrics)
+    replay_ = subparsers.add_parser("replay", help="recorder cost per callback and lockstep replay speed")
+    replay_.add_argument("--seconds", type=float, default=180)
+    replay_.set_defaults(run=bench_replay)
+    broadcast = subparsers.add_parser("broadcast", help="OSC and WebSocket fan-out latency with many subscribers")
+    broadcast.add_argument("--websocket", type=int, default=300)
+    broadcast.add_argument("--osc", type=int, default=200)
+    broadcast.add_argument("--stalled", type=int, default=2, help="WebSocket clients that never read")
+    broadcast.add_argument("--updates", type=int, default=200)
+    broadcast.add_argument("--interval", type=float, default=0.02, help="seconds between tempo updates")
+    broadcast.add_argument("--slow-seconds", type=float, default=1.0)
+    broadcast.add_argument("--burst", type=int, default=2000, help="updates for the stalled clients alone")
+    broadcast.set_defaults(run=bench_broadcast)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,93 @@
+import functools
 import sys
 import warnings
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 from threading import Thread
-from time import sleep
+from time import perf_counter, sleep
 
-import link
 import numpy as np
-import pyaudio
 import PySimpleGUI as sg
-import rtmidi
 from psgtray import SystemTray
-from collections import deque
 import threading
-import struct
+import Metrics
 import UserInterface
-import ExtractBpmPatterns
+from datetime import datetime
 import re
 import json
 import os
-from scipy import signal
-
-print("----")
-print("Live BPM Analyzer Version 2.0")
-print("© 2023 Matthias Schmid")
-print("----")
-
-FRAME_RATE = int(11025)
-
-try:
-    BPM_PATTERN = np.load("bpm_pattern.npy")
-    BPM_PATTERN_FINE = np.load("bpm_pattern_fine.npy")
-except FileNotFoundError:
-    ExtractBpmPatterns.extract(FRAME_RATE)
-    BPM_PATTERN = np.load("bpm_pattern.npy")
-    BPM_PATTERN_FINE = np.load("bpm_pattern_fine.npy")
+import queue
+from AnalyzerCore import (
+    FRAME_RATE,
+    TEMPO_ENGINE,
+    TEMPO_ENGINES,
+    AnalysisScheduler,
+    BpmAnalyzer,
+    BpmStorage,
+    RingBuffer,
+    tempo_engine,
+)
+from LinkPublisher import LinkPublisher
+from MidiClock import MidiClock
+from Recording import Recorder, ReplayStreamer
+from TempoServer import TempoServer
+
+# send 24 PPQN MIDI clock at the detected tempo on the selected MIDI output
+MIDI_CLOCK_OUT = True
+
+# push every analyzer result that moved by LINK_FOLLOW_DELTA BPM to the Link
+# session, at most once per LINK_FOLLOW_INTERVAL seconds
+LINK_AUTO_FOLLOW = False
+LINK_FOLLOW_DELTA = 0.05
+LINK_FOLLOW_INTERVAL = 1.0
+# map the detected beats onto the Link beat grid; forcing moves all peers
+LINK_BEAT_SYNC = True
+LINK_FORCE_BEAT = False
+
+# serve analyzer metrics on http://127.0.0.1:METRICS_PORT/metrics (Prometheus
+# text) and /metrics.json; None records nothing
+METRICS_PORT = None
+
+# record the raw input into a new WAV file in this directory every time the
+# stream starts, keeping at most the last RECORD_MAX_SECONDS
+RECORD_DIRECTORY = None
+RECORD_MAX_SECONDS = 3600
+# analyze this recording instead of an audio input, REPLAY_SPEED times real
+# time (None: as fast as the analyzer keeps up)
+REPLAY_FILE = None
+REPLAY_SPEED = 1.0
+
+# broadcast tempo, confidence and beats to OSC subscribers (they send
+# /bpm/subscribe to BROADCAST_OSC_PORT, or are listed as (host, port) in
+# BROADCAST_OSC_TARGETS) and to WebSocket clients on BROADCAST_WEBSOCKET_PORT;
+# "0.0.0.0" as BROADCAST_HOST lets any machine on the network subscribe
+BROADCAST_HOST = "127.0.0.1"
+BROADCAST_OSC_PORT = None
+BROADCAST_OSC_TARGETS = []
+BROADCAST_WEBSOCKET_PORT = None
 
 
 class ThreadingEvents:
     def __init__(self):
         self.stop_analyzer = threading.Event()
         self.stop_trigger_set_bpm = threading.Event()
-        self.stop_update_link_button = threading.Event()
         self.stop_refresh_main_window = threading.Event()
         self.bpm_updated = threading.Event()
 
     def stop_threads(self) -> None:
         self.stop_analyzer.set()
         self.stop_trigger_set_bpm.set()
-        self.stop_update_link_button.set()
         self.stop_refresh_main_window.set()
         
-    def start_update_link_button_thread(main_window: object, modules: object) -> None:
-        Thread(
-            target=UserInterface.update_link_button,
-            args=(main_window, modules),
-        ).start()
-        
     def start_refresh_main_window_thread(main_window: object, modules: object) -> None:
         Thread(
             target=WindowReader.refresh_main_window,
             args=(main_window, modules),
         ).start()
         
-    def start_trigger_set_bpm_thread(modules: object, user_mapping: object) -> None:
-        Thread(
-            target=modules.midi_interface.trigger_set_bpm,
-            args=(modules, user_mapping),
-        ).start()
+    def start_trigger_set_bpm(modules: object, user_mapping: object) -> None:
+        modules.midi_interface.trigger_set_bpm(modules, user_mapping)
         
     def start_run_analyzer_thread(modules: object) -> None:
         Thread(
@@ -76,54 +95,80 @@ class ThreadingEvents:
         ).start()
         
 
-class BpmStorage:
-    def __init__(self):
-        self._float = 120.00  # default
-        self._str = "***.**"  # default
-        self.average_window = deque(maxlen=3)
-
-
 class AbletonLink:
     def __init__(self):
+        import link
+
         self.link = link.Link(120.00)
         self.link.startStopSyncEnabled = True
         self.link.enabled = False
+        # Link reports peers joining and leaving on its own thread
+        self.peers_changed = None
+        self.link.setNumPeersCallback(self.num_peers_changed)
+        self.publisher = LinkPublisher(
+            self.link,
+            LINK_AUTO_FOLLOW,
+            LINK_FOLLOW_DELTA,
+            LINK_FOLLOW_INTERVAL,
+            LINK_BEAT_SYNC,
+            LINK_FORCE_BEAT,
+        )
 
     def enable(self, bool: bool) -> None:
         self.link.enabled = bool
 
-    def num_peers(self) -> int:
-        return self.link.numPeers()
+    def num_peers_changed(self, peers: int) -> None:
+        peers_changed = self.peers_changed
+        if peers_changed is not None and self.link.enabled:
+            peers_changed(peers)
 
     def set_bpm(self, bpm: float) -> None:
-        for value in [0.001, -0.001]:
-            bpm += value
-            s = self.link.captureSessionState()
-            link_time = self.link.clock().micros()
-            s.setTempo(bpm, link_time)
-            self.link.commitSessionState(s)
-            sleep(0.03)
+        # returns at once, the publisher thread commits it
+        self.publisher.set_bpm(bpm)
 
 
 class AudioStreamer:
     def __init__(self, frame_rate: int, operating_range_seconds=12):
+        import pyaudio
+
+        self.pyaudio = pyaudio
         self.frame_rate = frame_rate
         self.format = pyaudio.paInt16
         self.chunk = 10240
         self.audio = pyaudio.PyAudio()
-        self.signal_buffer = deque(maxlen=int(frame_rate * operating_range_seconds))
+        self.signal_buffer = RingBuffer(int(frame_rate * operating_range_seconds))
         self.operating_range_seconds = operating_range_seconds
         self.buffer_updated = threading.Event()
         self.stream = None
+        self.last_callback = None
+        self.recorder = None
 
     def audio_callback(self, in_data: bytes, frame_count, time_info, status) -> None:
-        num_int16_values = len(in_data) // 2
-        signal_buffer_int = struct.unpack(f"<{num_int16_values}h", in_data)
-        self.signal_buffer.extend(signal_buffer_int)
+        samples = np.frombuffer(in_data, dtype="<i2")
+        self.signal_buffer.write(samples)
         self.buffer_updated.set()
-        return (None, pyaudio.paContinue)
+        if self.recorder is not None:
+            self.recorder.write(samples)
+        if Metrics.METRICS is not None:
+            self.observe_callback(Metrics.METRICS, frame_count, status)
+        return (None, self.pyaudio.paContinue)
+
+    def observe_callback(self, metrics: Metrics.Metrics, frame_count: int, status: int) -> None:
+        # an overrun is an input overflow, or a callback that came more than
+        # half a chunk late
+        now = perf_counter()
+        if self.last_callback is not None:
+            interval = now - self.last_callback
+            metrics.observe("audio_callback_interval_seconds", interval)
+            if status & self.pyaudio.paInputOverflow or interval > 1.5 * frame_count / self.frame_rate:
+                metrics.increment("audio_callback_overruns_total")
+        self.last_callback = now
 
     def start_stream(self, input_device_index) -> None:
+        if RECORD_DIRECTORY:
+            os.makedirs(RECORD_DIRECTORY, exist_ok=True)
+            path = os.path.join(RECORD_DIRECTORY, datetime.now().strftime("bpm_%Y%m%d_%H%M%S.wav"))
+            self.recorder = Recorder(path, self.frame_rate, RECORD_MAX_SECONDS)
         self.stream = self.audio.open(
             format=self.format,
             channels=1,
@@ -136,16 +181,13 @@ class AudioStreamer:
         )
         self.stream.start_stream()
 
-    def get_buffer(self) -> np.ndarray:
-        self.buffer_updated.wait()
-        buffer = np.array(self.signal_buffer, dtype=np.int16)
-        self.buffer_updated.clear()
-        return buffer
-
     def stop_stream(self):
         self.stream.stop_stream()
         self.stream.close()
         self.audio.terminate()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
     def available_audio_devices(self) -> list:
         devices = []
@@ -169,120 +211,10 @@ class AudioStreamer:
         return [devices, indices_of_devices]
 
 
-class BpmAnalyzer:
-    def search_beat_events(signal_array: np.ndarray, frame_rate: int) -> np.ndarray:
-        step_size = frame_rate // 2
-        events = []
-        for step_start in range(0, len(signal_array), step_size):
-            signal_array_window = signal_array[step_start : step_start + step_size]
-            signal_array_window[signal_array_window < signal_array_window.max()] = 0
-            signal_array_window[signal_array_window > 0] = 1
-            event = np.argmax(signal_array_window) + step_start
-            events.append(event)
-        return np.array(events, dtype=np.int64)
-
-    def bpm_container(beat_events: np.ndarray, bpm_pattern: np.ndarray, steps: int) -> list[list]:
-        bpm_container = [list(np.zeros((1,), dtype=np.int64))for _ in range(beat_events.size * steps)]
-        for i, beat_event in enumerate(beat_events):
-            found_in_pattern = np.where(np.logical_and(bpm_pattern >= beat_event - 20, bpm_pattern <= beat_event + 20))
-            for x, q in enumerate(found_in_pattern[0]):
-                bpm_container[i * steps + q].append(found_in_pattern[1][x])
-        return bpm_container
-
-    def wrap_bpm_container(bpm_container: list, steps: int) -> list[list]:
-        def flatten(input_list: list) -> list:
-            return [item for sublist in input_list for item in sublist]
-
-        bpm_container_wrapped = [list(np.zeros((1,), dtype=np.int64)) for _ in range(steps)]
-        for i, w in enumerate(bpm_container_wrapped):
-            w.extend(flatten(bpm_container[i::steps]))
-            w.remove(0)
-            bpm_container_wrapped[i] = list(filter(lambda num: num != 0, w))
-        return bpm_container_wrapped
-
-    def finalise_bpm_container(bpm_container_wrapped: list, steps: int) -> np.ndarray:
-        bpm_container_final = np.zeros((steps, 1), dtype=np.int64)
-        for i, w in enumerate(bpm_container_wrapped):
-            values, counts = np.unique(w, return_counts=True)
-            values = values[counts == counts.max()]
-            if values[0] > 0:
-                count = np.count_nonzero(w == values[0])
-                bpm_container_final[i] = count
-        return bpm_container_final
-
-    def get_bpm_wrapped(bpm_container_final: np.ndarray) -> np.ndarray:
-        return np.where(bpm_container_final == np.amax(bpm_container_final))
-
-    def check_bpm_wrapped(bpm_wrapped: np.ndarray, bpm_container_final: np.ndarray) -> bool:
-        count = np.count_nonzero(bpm_container_final == bpm_wrapped[0][0])
-        if count > 1 or bpm_container_final[int(bpm_wrapped[0][0])] < 6:
-            return 0
-        else:
-            return 1
-
-    def get_bpm_pattern_fine_window(bpm_wrapped: np.ndarray) -> int:
-        start = int(((bpm_wrapped[0][0] / 4) / 0.05) - 20)
-        end = int(start + 40)
-        return start, end
-
-    def bpm_wrapped_to_float_str(bpm: np.ndarray, bpm_fine: np.ndarray) -> float:
-        bpm_float = round(
-            float((((bpm[0][0] / 4) + 100) - 1) + (bpm_fine[0][0] * 0.05)), 2
-        )
-        bpm_str = format(bpm_float, ".2f")
-        return bpm_float, bpm_str
-
-    def search_bpm(signal_array: np.ndarray, frame_rate: int) -> tuple:
-        bpm_pattern = BPM_PATTERN
-        bpm_pattern_fine = BPM_PATTERN_FINE
-        beat_events = BpmAnalyzer.search_beat_events(signal_array, frame_rate)
-        for switch_pattern in [240, 40]:
-            bpm_container = BpmAnalyzer.bpm_container(
-                beat_events, bpm_pattern, switch_pattern
-            )
-            bpm_container_wrapped = BpmAnalyzer.wrap_bpm_container(
-                bpm_container, switch_pattern
-            )
-            try:
-                bpm_container_final = BpmAnalyzer.finalise_bpm_container(
-                    bpm_container_wrapped, switch_pattern
-                )
-            except ValueError:
-                return 0
-            bpm_wrapped = BpmAnalyzer.get_bpm_wrapped(bpm_container_final)
-            if not BpmAnalyzer.check_bpm_wrapped(bpm_wrapped, bpm_container_final):
-                return 0
-            if switch_pattern == 240:
-                start, end = BpmAnalyzer.get_bpm_pattern_fine_window(bpm_wrapped)
-                bpm_pattern = bpm_pattern_fine[start:end]
-                bpm_wrapped_full_range = bpm_wrapped
-            else:
-                bpm_wrapped_fine_range = bpm_wrapped
-                return BpmAnalyzer.bpm_wrapped_to_float_str(
-                    bpm_wrapped_full_range, bpm_wrapped_fine_range
-                )
-
-    def run_analyzer(modules: object) -> None:
-        while not modules.threading_events.stop_analyzer.is_set():
-            buffer = modules.audio_streamer.get_buffer()
-            buffer = bandpass_filter(buffer)
-            if bpm_float_str := BpmAnalyzer.search_bpm(buffer, FRAME_RATE):
-                modules.bpm_storage.average_window.append(bpm_float_str[0])
-                bpm_average = round(
-                    (
-                        sum(modules.bpm_storage.average_window)
-                        / len(modules.bpm_storage.average_window)
-                    ),
-                    2,
-                )
-                (
-                    modules.bpm_storage._float,
-                    modules.bpm_storage._str,
-                ) = bpm_average, format(bpm_average, ".2f")
-
-
 class MidiInterface:
     def __init__(self):
+        import rtmidi
+
         self.midi_in = rtmidi.MidiIn()
         self.midi_out = rtmidi.MidiOut()
 
@@ -323,36 +255,47 @@ class MidiInterface:
                     self.midi_out.open_port(int(midi_device[choosen_midi_device_out]))
                 except: pass
 
-    def learn(self):
-        count = 0
-        while True:
-            sleep(0.2)
-            midi_in_msg = self.midi_in.get_message()
-            if midi_in_msg == None:
-                if count >= 1:
-                    if midi_in_msg == None:
-                        break
-            else:
-                count =+ 1
-                if count == 1:
-                    user_mapping = str(midi_in_msg)
+    def learn(self, quiet_seconds=0.2):
+        # the first three byte message is the mapping; returns once the input
+        # has been quiet for quiet_seconds, so the rest of the burst is dropped
+        learned = []
+        message_arrived = threading.Event()
+
+        def on_message(event: tuple, data) -> None:
+            message, _ = event
+            if not learned and len(message) == 3:
+                learned.append(message)
+            if learned:
+                message_arrived.set()
+
+        self.midi_in.set_callback(on_message)
         try:
-            return convert_midi_msg(user_mapping)
-        except: pass
+            message_arrived.wait()
+            message_arrived.clear()
+            while message_arrived.wait(quiet_seconds):
+                message_arrived.clear()
+        finally:
+            self.midi_in.cancel_callback()
+        return [str(value) for value in learned[0]]
 
     def trigger_set_bpm(self, modules: object, user_mapping):
-        while not modules.threading_events.stop_trigger_set_bpm.is_set():
-            sleep(0.02)
-            midi_in_msg = str(self.midi_in.get_message())
-            try:
-                midi_in_msg = convert_midi_msg(midi_in_msg)
-            except: pass
-            if midi_in_msg == user_mapping:
+        # rtmidi calls on_message from its own thread as soon as a message arrives
+        try:
+            mapping = midi_mapping_key(user_mapping)
+        except (TypeError, ValueError):
+            return
+
+        def on_message(event: tuple, data) -> None:
+            message, _ = event
+            if tuple(message) == mapping and not modules.threading_events.stop_trigger_set_bpm.is_set():
                 modules.ableton_link.set_bpm(modules.bpm_storage._float)
-                
+
+        self.midi_in.set_callback(on_message)
+
     def close_ports(self):
-        self.midi_in.close_port
-        self.midi_out.close_port
+        self.midi_in.cancel_callback()
+        self.midi_in.close_port()
+        self.midi_out.close_port()
 
 
 class WindowReader:
@@ -372,6 +315,8 @@ class WindowReader:
             if event == "board":
                 choosen_audio_device = get_choosen_audio_device(values, audio_devices)
                 choose_input_window["Next"].update(disabled=False)
+            if event == "engine":
+                Settings.save(tempo_engine=values["engine"])
         choose_input_window.hide()
         return choosen_audio_device
 
@@ -414,6 +359,7 @@ class WindowReader:
                 modules.midi_interface.set_out_device(
                     choosen_device, midi_devices["midi_devices_out"]
                 )
+                Settings.save(midi_device_out=choosen_device)
                 set_out = True
                 if set_in == True:
                     midi_device_selection_window.Element("learnsendbpm").Update(
@@ -460,11 +406,13 @@ class WindowReader:
                     button_color=(("white on blue", "black on white")[switch_button]),
                 )
                 if switch_button == True:
-                    modules.threading_events.stop_update_link_button.set()
+                    modules.ableton_link.peers_changed = None
                     modules.ableton_link.enable(False)
                 if switch_button == False:
+                    modules.ableton_link.peers_changed = functools.partial(
+                        UserInterface.update_link_button, main_window
+                    )
                     modules.ableton_link.enable(True)
-                    ThreadingEvents.start_update_link_button_thread(main_window, modules)
             if event == "settings":
                 modules.threading_events.stop_threads()
                 modules.ableton_link.enable(False)
@@ -475,9 +423,13 @@ class WindowReader:
                 modules.ableton_link.set_bpm(modules.bpm_storage._float)
 
     def refresh_main_window(main_window: object, modules: object) -> None:
+        bpm_updates = modules.analysis_scheduler.subscribe_queue()
         while not modules.threading_events.stop_refresh_main_window.is_set():
-            sleep(1)
-            main_window["bpm"].update(modules.bpm_storage._str)
+            try:
+                _, bpm_str = bpm_updates.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            main_window["bpm"].update(bpm_str)
 
 
 class OpenWindow:
@@ -487,7 +439,7 @@ class OpenWindow:
     def audio_device_selection(self, modules: object) -> int:
         audio_devices = modules.audio_streamer.available_audio_devices()
         audio_device_selection_window = UserInterface.audio_device_selection(
-            audio_devices, self.resolution
+            audio_devices, self.resolution, list(TEMPO_ENGINES), TEMPO_ENGINE
         )
         choosen_audio_device = WindowReader.audio_device_selection(
             audio_device_selection_window, audio_devices
@@ -533,13 +485,17 @@ class Settings:
                 json.dump(content, settings)
             return 0
 
-    def save(choosen_audio_device=None, user_mapping=None) -> None:
+    def save(choosen_audio_device=None, user_mapping=None, midi_device_out=None, tempo_engine=None) -> None:
         with open("settings.json", "r") as settings:
             content = json.load(settings)
         if choosen_audio_device is not None:
             content["choosen_audio_device"] = choosen_audio_device
         if user_mapping is not None:
             content["user_mapping"] = user_mapping
+        if midi_device_out is not None:
+            content["midi_device_out"] = midi_device_out
+        if tempo_engine is not None:
+            content["tempo_engine"] = tempo_engine
         with open("settings.json", "w") as settings:
             json.dump(content, settings)
 
@@ -551,47 +507,53 @@ class Settings:
                 settings_lst.append(value)
             return settings_lst
 
+    def get(key: str, default=None):
+        with open("settings.json", "r") as settings:
+            return json.load(settings).get(key, default)
+
 
 class InitialiseModules:
     def __init__(self):
         self.bpm_storage = BpmStorage()
         self.threading_events = ThreadingEvents()
-        self.audio_streamer = AudioStreamer(FRAME_RATE)
+        if REPLAY_FILE:
+            self.audio_streamer = ReplayStreamer(REPLAY_FILE, FRAME_RATE, REPLAY_SPEED)
+        else:
+            self.audio_streamer = AudioStreamer(FRAME_RATE)
+        self.analysis_scheduler = AnalysisScheduler(
+            self.audio_streamer.signal_buffer, self.audio_streamer.buffer_updated, self.bpm_storage
+        )
+        if REPLAY_FILE:
+            self.audio_streamer.analysis_scheduler = self.analysis_scheduler
         self.ableton_link = AbletonLink()
         self.midi_interface = MidiInterface()
+        self.analysis_scheduler.subscribe(self.ableton_link.publisher.follow)
+        self.analysis_scheduler.subscribe_beat(self.ableton_link.publisher.follow_beat)
+        self.tempo_server = None
+        if BROADCAST_OSC_PORT is not None or BROADCAST_OSC_TARGETS or BROADCAST_WEBSOCKET_PORT is not None:
+            self.tempo_server = TempoServer(
+                BROADCAST_OSC_PORT, BROADCAST_WEBSOCKET_PORT, BROADCAST_OSC_TARGETS, BROADCAST_HOST
+            )
+            self.tempo_server.start()
+            self.analysis_scheduler.subscribe_result(self.tempo_server.publish_result)
+            self.analysis_scheduler.subscribe(self.tempo_server.publish_tempo)
+            self.analysis_scheduler.subscribe_beat(self.tempo_server.publish_beat)
+        self.midi_clock = MidiClock(self.midi_interface.midi_out.send_message, self.bpm_storage)
         self.open_window = OpenWindow()
         
 
-def convert_midi_msg(msg) -> str:
-        for char in "()[]":
-            msg = msg.replace(char, "")
-        msg = msg.split(",", -1)
-        del msg[3]
-        for i, value in enumerate(msg):
-            msg[i] = value.strip()
-        return msg
-
-
-def bandpass_filter(audio_signal, lowcut=60.0, highcut=3000.0) -> np.ndarray:
-    def butter_bandpass(lowcut, highcut, fs, order=10):
-            nyq = 0.5 * fs
-            low = lowcut / nyq
-            high = highcut / nyq
-            b, a = signal.butter(order, [low, high], btype='band')
-            return b, a
-
-    def butter_bandpass_filter(data, lowcut, highcut, fs, order=10):
-        b, a = butter_bandpass(lowcut, highcut, fs, order=order)
-        y = signal.lfilter(b, a, data)
-        return y
-
-    def _bandpass_filter(buffer):
-        return butter_bandpass_filter(buffer, lowcut, highcut, FRAME_RATE, order=6)
-    
-    return np.apply_along_axis(_bandpass_filter, 0, audio_signal).astype('int16')
+def midi_mapping_key(user_mapping: list) -> tuple:
+    # settings store the mapping as strings, rtmidi delivers lists of ints
+    return tuple(int(value) for value in user_mapping)
 
 
 def main() -> None:
+    print("----")
+    print("Live BPM Analyzer Version 2.0")
+    print("© 2023 Matthias Schmid")
+    print("----")
+    if METRICS_PORT is not None:
+        Metrics.MetricsServer(Metrics.enable(), METRICS_PORT).start()
     while True:
         modules = InitialiseModules()
         if not Settings.check():
@@ -600,18 +562,33 @@ def main() -> None:
         else:
             settings = Settings.open()
             choosen_audio_device, user_mapping = int(settings[0]), settings[1]
+            if midi_device_out := Settings.get("midi_device_out"):
+                modules.midi_interface.set_out_device(
+                    midi_device_out, modules.midi_interface.get_available_devices()["midi_devices_out"]
+                )
+        modules.analysis_scheduler.engine = tempo_engine(Settings.get("tempo_engine", TEMPO_ENGINE))
         modules.audio_streamer.start_stream(choosen_audio_device)
-        ThreadingEvents.start_trigger_set_bpm_thread(modules, user_mapping)
+        ThreadingEvents.start_trigger_set_bpm(modules, user_mapping)
         ThreadingEvents.start_run_analyzer_thread(modules)
+        if MIDI_CLOCK_OUT and modules.midi_interface.midi_out.is_port_open():
+            modules.midi_clock.start()
         if modules.open_window.main_window(modules): # Main loop
             modules.audio_streamer.stop_stream()
-            modules.midi_interface.close_ports
-            ThreadingEvents.stop_threads
+            modules.threading_events.stop_threads()
+            modules.midi_clock.stop()
+            modules.ableton_link.publisher.stop()
+            if modules.tempo_server is not None:
+                modules.tempo_server.stop()
+            modules.midi_interface.close_ports()
             os.remove("settings.json")
         else:
             modules.audio_streamer.stop_stream()
-            modules.midi_interface.close_ports
-            ThreadingEvents.stop_threads
+            modules.threading_events.stop_threads()
+            modules.midi_clock.stop()
+            modules.ableton_link.publisher.stop()
+            if modules.tempo_server is not None:
+                modules.tempo_server.stop()
+            modules.midi_interface.close_ports()
             sys.exit()
 
 
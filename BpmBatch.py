@@ -0,0 +1,180 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from math import gcd
+from time import perf_counter
+
+import numpy as np
+from scipy import signal
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg", ".aiff", ".aif")
+FIELDS = ["path", "bpm", "windows", "accepted", "error"]
+
+
+def find_audio_files(paths: list) -> list:
+    audio_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                audio_files.extend(
+                    os.path.abspath(os.path.join(root, file))
+                    for file in sorted(files)
+                    if file.lower().endswith(AUDIO_EXTENSIONS)
+                )
+        else:
+            audio_files.append(os.path.abspath(path))
+    return audio_files
+
+
+def wav_blocks(path: str, block_seconds: float):
+    with wave.open(path, "rb") as wav:
+        frame_rate, channels, width = wav.getframerate(), wav.getnchannels(), wav.getsampwidth()
+        block_frames = int(block_seconds * frame_rate)
+        while frames := wav.readframes(block_frames):
+            if width == 1:
+                block = np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128
+            elif width == 3:
+                raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+                raw[:, 2] = raw[:, 2].astype(np.uint8).view(np.int8)
+                block = (raw[:, 0] | raw[:, 1] << 8 | raw[:, 2] << 16).astype(np.float32)
+            else:
+                block = np.frombuffer(frames, dtype=f"<i{width}").astype(np.float32)
+            # every format at the int16 scale the live input has
+            block *= 32768 / 2 ** (8 * width - 1)
+            yield block.reshape(-1, channels).mean(axis=1), frame_rate
+
+
+def soundfile_blocks(path: str, block_seconds: float):
+    try:
+        import soundfile
+    except ImportError:
+        raise RuntimeError("reading non-WAV files needs the soundfile package")
+    frame_rate = soundfile.info(path).samplerate
+    for block in soundfile.blocks(path, blocksize=int(block_seconds * frame_rate), dtype="float32", always_2d=True):
+        yield block.mean(axis=1) * 32768, frame_rate  # floats in +-1 to the int16 scale
+
+
+def read_windows(path: str, frame_rate: int, window_seconds: float, hop_seconds: float):
+    blocks = wav_blocks if path.lower().endswith(".wav") else soundfile_blocks
+    window_frames = int(window_seconds * frame_rate)
+    hop_frames = int(hop_seconds * frame_rate)
+    pending = np.zeros(0, dtype=np.float32)
+    windows = 0
+    for block, source_rate in blocks(path, hop_seconds):
+        if source_rate != frame_rate:
+            common = gcd(frame_rate, source_rate)
+            block = signal.resample_poly(block, frame_rate // common, source_rate // common)
+        pending = np.concatenate((pending, block.astype(np.float32)))
+        while pending.size >= window_frames:
+            yield pending[:window_frames]
+            windows += 1
+            pending = pending[hop_frames:]
+    if not windows and pending.size:
+        yield pending
+
+
+def analyze_file(path: str, window_seconds: float, hop_seconds: float, engine=None) -> dict:
+    from AnalyzerCore import FRAME_RATE, bandpass_filter, tempo_engine
+
+    result = {"path": path, "bpm": "", "windows": 0, "accepted": 0, "error": ""}
+    estimates = []
+    try:
+        for window in read_windows(path, FRAME_RATE, window_seconds, hop_seconds):
+            result["windows"] += 1
+            if bpm_result := tempo_engine(engine).search_bpm(bandpass_filter(window), FRAME_RATE):
+                estimates.append(bpm_result.bpm)
+    except Exception as error:
+        result["error"] = f"{type(error).__name__}: {error}"
+    result["accepted"] = len(estimates)
+    if estimates:
+        result["bpm"] = format(float(np.median(estimates)), ".2f")
+    return result
+
+
+class ResultWriter:
+    # Appends one line per finished file and flushes it, so an interrupted run
+    # can be resumed from whatever made it to disk.
+    def __init__(self, path: str):
+        self.path = path
+        self.json_lines = path.lower().endswith((".jsonl", ".json"))
+        self.done = self.read_done()
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a", newline="")
+        if not new_file:
+            with open(path, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    self.file.write("\n")  # end the half-written line of a crashed run, it is skipped
+        if not self.json_lines:
+            self.writer = csv.DictWriter(self.file, fieldnames=FIELDS)
+            if new_file:
+                self.writer.writeheader()
+
+    def read_done(self) -> set:
+        done = set()
+        try:
+            with open(self.path, "r", newline="") as results:
+                if self.json_lines:
+                    for line in results:
+                        try:
+                            done.add(json.loads(line)["path"])
+                        except (json.JSONDecodeError, KeyError, TypeError):
+                            pass
+                else:
+                    for row in csv.DictReader(results):
+                        if None not in row.values() and row.get("path"):
+                            done.add(row["path"])
+        except FileNotFoundError:
+            pass
+        return done
+
+    def write(self, result: dict) -> None:
+        if self.json_lines:
+            self.file.write(json.dumps(result) + "\n")
+        else:
+            self.writer.writerow(result)
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="bpm-batch", description="Tag audio files with their tempo")
+    parser.add_argument("paths", nargs="+", help="audio files or directories")
+    parser.add_argument("-o", "--output", default="bpm_results.csv", help=".csv or .jsonl result file")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--window", type=float, default=12.0, help="analysis window in seconds")
+    parser.add_argument("--hop", type=float, default=12.0, help="seconds between windows")
+    parser.add_argument("--engine", help="tempo engine, defaults to TEMPO_ENGINE in AnalyzerCore.py")
+    args = parser.parse_args()
+
+    import AnalyzerCore
+
+    AnalyzerCore.tempo_engine(args.engine)  # fails on an unknown name before any file is read
+    AnalyzerCore.shared_pattern_cache()
+
+    result_writer = ResultWriter(args.output)
+    pending = [path for path in find_audio_files(args.paths) if path not in result_writer.done]
+    print(f"{len(result_writer.done)} files done, {len(pending)} to go", file=sys.stderr)
+    start = perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(analyze_file, path, args.window, args.hop, args.engine) for path in pending]
+            for count, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                result_writer.write(result)
+                print(f"[{count}/{len(pending)}] {result['bpm'] or '---.--':>7} {result['path']}", file=sys.stderr)
+    finally:
+        result_writer.close()
+    minutes = (perf_counter() - start) / 60
+    if pending and minutes:
+        print(f"{len(pending) / minutes:.1f} files/min with {args.workers} workers", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
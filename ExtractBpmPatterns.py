@@ -1,51 +1,175 @@
+import argparse
+import hashlib
+import json
+import os
+
 import numpy as np
 
+CACHE_VERSION = 1
+
+
+# Every pattern entry is k * period + offset, so a pattern is fully described
+# by its beat periods. Slices are built on demand from a (tempo x beat) base
+# table plus a broadcast of the offset grid.
+class BpmPattern:
+    def __init__(
+        self,
+        frame_rate: int,
+        min_bpm: float,
+        max_bpm: float,
+        step: float,
+        first_row: int,
+        offset_step=20,
+        beats=32,
+        fractional=False,
+    ):
+        self.frame_rate = frame_rate
+        self.min_bpm = min_bpm
+        self.max_bpm = max_bpm
+        self.step = step
+        self.offset_step = offset_step
+        self.parameters = {
+            "frame_rate": frame_rate,
+            "min_bpm": min_bpm,
+            "max_bpm": max_bpm,
+            "step": step,
+            "first_row": first_row,
+            "offset_step": offset_step,
+            "beats": beats,
+            "fractional": fractional,
+        }
+        rows = int(round((max_bpm - min_bpm) / step))
+        lengh = int((frame_rate / 2) / offset_step)
+        # accumulated like the original generator so the float rounding matches
+        add = np.concatenate(([0.0], np.cumsum(np.full(rows, step))))[first_row : first_row + rows]
+        self.bpms = min_bpm + add  # the tempo of every row
+        self.offsets = (np.arange(1, lengh + 1) * offset_step).astype(np.int32)
+        if fractional:
+            # at low rates a truncated period drifts off the beats within a few
+            # bars, so every beat is rounded on its own
+            self.periods = 60 / (min_bpm + add) * frame_rate
+            self.base = np.round(self.periods[:, None] * np.arange(beats)).astype(np.int32)
+        else:
+            self.periods = (60 / (min_bpm + add) * frame_rate).astype(np.int32)
+            self.base = self.periods[:, None] * np.arange(beats, dtype=np.int32)
+        self.shape = (rows, lengh, beats)
+        self.cached = None
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, rows: slice) -> np.ndarray:
+        if self.cached is not None:
+            return self.cached[rows]
+        return self.base[rows][:, None, :] + self.offsets[None, :, None]
+
+    def use_cache(self, name: str, directory=".") -> "BpmPattern":
+        self.cached = load_cached(name, self.parameters, lambda: self[:], directory)
+        return self
+
+    def coarse(frame_rate: int, min_bpm=100.0, max_bpm=160.0, step=0.25, offset_step=20) -> "BpmPattern":
+        return BpmPattern(frame_rate, min_bpm, max_bpm, step, 1, offset_step)
+
+    def fine(frame_rate: int, min_bpm=100.0, max_bpm=160.0, step=0.05, offset_step=20) -> "BpmPattern":
+        return BpmPattern(frame_rate, min_bpm, max_bpm, step, 0, offset_step)
+
+    def decimated(frame_rate: int, decimation=64, min_bpm=100.0, max_bpm=160.0, step=1.0) -> "BpmPattern":
+        # for an envelope at frame_rate / decimation, one frame per offset
+        return BpmPattern(frame_rate / decimation, min_bpm, max_bpm, step, 0, 1, fractional=True)
+
+
+def checksum(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as cache_file:
+        for block in iter(lambda: cache_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_atomic(path: str, write) -> None:
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as cache_file:
+            write(cache_file)
+            cache_file.flush()
+            os.fsync(cache_file.fileno())
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
 
-def extract_bpm_pattern(lengh: int, frame_rate: int) -> None:
-    array = np.full((240, lengh, 32), 0, dtype=np.int64)
-    jump = int(0)
-    add = 0
-
-    for i in range(240):
-        add += 0.25
-        timestamp = int(60 / (100 + add) * frame_rate)
-        jump = int(0)
-        for x in range(lengh):
-            timestamp_next = 0
-            jump += 20
-            for y in range(32):
-                array[i][x][y] = timestamp_next
-                timestamp_next += timestamp
-            array[i][x] = array[i][x] + jump  
-            
-    np.save("bpm_pattern.npy", array)
-
-
-def extract_bpm_pattern_fine(lengh: int, frame_rate: int) -> None:
-    array = np.full((1200, lengh, 32), 0, dtype=np.int64)
-    jump = int(0)
-    add = 0
-    
-    for i in range(1200):
-        timestamp = int(60 / (100 + add) * frame_rate)
-        add += 0.05
-        jump = int(0)
-        for x in range(lengh):
-            timestamp_next = 0
-            jump += 20
-            for y in range(32):
-                array[i][x][y] = timestamp_next
-                timestamp_next += timestamp
-            array[i][x] = array[i][x] + jump
-            
-    np.save("bpm_pattern_fine.npy", array)
-
-
-def extract(frame_rate: int):
+
+def save_cached(array: np.ndarray, parameters: dict, name: str, directory=".") -> None:
+    path = os.path.join(directory, name)
+    write_atomic(f"{path}.npy", lambda cache_file: np.save(cache_file, array))
+    header = {
+        "version": CACHE_VERSION,
+        "parameters": parameters,
+        "shape": list(array.shape),
+        "dtype": str(array.dtype),
+        "sha256": checksum(f"{path}.npy"),
+    }
+    write_atomic(f"{path}.json", lambda cache_file: cache_file.write(json.dumps(header).encode()))
+
+
+def read_header(name: str, directory=".") -> dict:
+    try:
+        with open(os.path.join(directory, f"{name}.json"), "r") as header:
+            return json.load(header)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def is_stale(parameters: dict, name: str, directory=".", verify=True) -> bool:
+    header = read_header(name, directory)
+    if header.get("version") != CACHE_VERSION or header.get("parameters") != parameters:
+        return True
+    path = os.path.join(directory, f"{name}.npy")
+    if not os.path.exists(path):
+        return True
+    return verify and checksum(path) != header["sha256"]
+
+
+# Arrays come back memory-mapped read-only, so every process that opens the
+# same cache file shares its physical pages.
+def load_cached(name: str, parameters: dict, build, directory=".", verify=True) -> np.ndarray:
+    if is_stale(parameters, name, directory, verify):
+        save_cached(build(), parameters, name, directory)
+    return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+
+
+def extract_bpm_pattern(bpm_pattern: BpmPattern, name: str, directory=".") -> None:
+    save_cached(bpm_pattern[:], bpm_pattern.parameters, name, directory)
+
+
+def extract(
+    frame_rate: int,
+    min_bpm=100.0,
+    max_bpm=160.0,
+    coarse_step=0.25,
+    fine_step=0.05,
+    offset_step=20,
+):
     print("PATTERN CREATOR")
     print("extracting...")
-    lengh = int((frame_rate / 2) / 20)
-    extract_bpm_pattern(lengh, frame_rate)
-    extract_bpm_pattern_fine(lengh, frame_rate)
+    extract_bpm_pattern(
+        BpmPattern.coarse(frame_rate, min_bpm, max_bpm, coarse_step, offset_step), "bpm_pattern"
+    )
+    extract_bpm_pattern(
+        BpmPattern.fine(frame_rate, min_bpm, max_bpm, fine_step, offset_step), "bpm_pattern_fine"
+    )
     print("\033[92m" + "COMPLETED" + "\033[0m")
-    
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the BPM pattern files")
+    parser.add_argument("--frame-rate", type=int, default=11025)
+    parser.add_argument("--min-bpm", type=float, default=100.0)
+    parser.add_argument("--max-bpm", type=float, default=160.0)
+    parser.add_argument("--coarse-step", type=float, default=0.25)
+    parser.add_argument("--fine-step", type=float, default=0.05)
+    parser.add_argument("--offset-step", type=int, default=20)
+    args = parser.parse_args()
+    extract(
+        args.frame_rate, args.min_bpm, args.max_bpm, args.coarse_step, args.fine_step, args.offset_step
+    )
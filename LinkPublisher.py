@@ -0,0 +1,152 @@
+import queue
+import threading
+from collections import deque
+from time import perf_counter, sleep
+
+import Metrics
+
+
+class LinkPublisher:
+    # Commits tempo changes to an Ableton Link session on its own thread, so
+    # callers only enqueue. Whatever is queued while a commit runs collapses
+    # into the newest value. Manual set_bpm calls are published right away;
+    # with auto_follow the analyzer results are published when they differ by
+    # at least follow_delta BPM, at most once per follow_interval seconds.
+    # With beat_sync the detected beats are mapped onto the session's beat
+    # grid on every publish, and with auto_follow also whenever the grid is
+    # more than phase_tolerance beats off.
+    def __init__(
+        self,
+        link: object,
+        auto_follow=False,
+        follow_delta=0.05,
+        follow_interval=1.0,
+        beat_sync=True,
+        force_beat=False,
+        quantum=4.0,
+        phase_tolerance=0.05,
+    ):
+        self.link = link
+        self.auto_follow = auto_follow
+        self.follow_delta = follow_delta
+        self.follow_interval = follow_interval
+        self.beat_sync = beat_sync
+        self.force_beat = force_beat
+        self.quantum = quantum
+        self.phase_tolerance = phase_tolerance
+        self.commands = queue.Queue()
+        self.beat = None  # latest (bpm, beat_phase, captured) from the analyzer
+        self.published = None
+        self.last_publish = float("-inf")
+        self.publish_latencies = deque(maxlen=100)  # seconds from enqueue to the first commit
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def set_bpm(self, bpm: float) -> None:
+        self.commands.put(("set", bpm, perf_counter()))
+
+    def follow(self, bpm: float, *_) -> None:
+        # fits AnalysisScheduler.subscribe
+        self.commands.put(("follow", bpm, perf_counter()))
+
+    def follow_beat(self, bpm: float, beat_phase: float, captured: float) -> None:
+        # fits AnalysisScheduler.subscribe_beat
+        self.commands.put(("beat", (bpm, beat_phase, captured), perf_counter()))
+
+    def stop(self) -> None:
+        self.commands.put(("stop", None, perf_counter()))
+        self.thread.join()
+
+    def run(self) -> None:
+        pending = None  # (bpm, enqueued, manual)
+        while True:
+            timeout = None
+            if pending is not None:
+                timeout = max(self.last_publish + self.follow_interval - perf_counter(), 0)
+            try:
+                command = self.commands.get(timeout=timeout)
+            except queue.Empty:
+                command = None
+            while command is not None:
+                kind, bpm, enqueued = command
+                if kind == "stop":
+                    return
+                if kind == "beat":
+                    self.beat = bpm
+                    if self.auto_follow and self.beat_sync and pending is None:
+                        pending = (None, enqueued, False)
+                elif kind == "set":
+                    pending = (bpm, enqueued, True)
+                elif self.auto_follow and not (pending and pending[2]):
+                    pending = (bpm, enqueued, False)
+                try:
+                    command = self.commands.get_nowait()
+                except queue.Empty:
+                    command = None
+            if pending is None:
+                continue
+            bpm, enqueued, manual = pending
+            if bpm is None:
+                # beat only, the tempo did not change
+                if perf_counter() < self.last_publish + self.follow_interval:
+                    continue
+                self.align(enqueued)
+                pending = None
+                continue
+            if not manual:
+                if self.published is not None and abs(bpm - self.published) < self.follow_delta:
+                    pending = None
+                    continue
+                if perf_counter() < self.last_publish + self.follow_interval:
+                    continue
+            self.publish(bpm, enqueued)
+            pending = None
+
+    def publish(self, bpm: float, enqueued: float) -> None:
+        # nudged up and back down so peers register the tempo even when it
+        # equals the current session tempo
+        for value in [0.001, -0.001]:
+            bpm += value
+            s = self.link.captureSessionState()
+            link_time = self.link.clock().micros()
+            s.setTempo(bpm, link_time)
+            if value < 0:
+                self.align_beat(s, link_time)
+            self.link.commitSessionState(s)
+            if value > 0:
+                self.publish_latencies.append(perf_counter() - enqueued)
+                if Metrics.METRICS is not None:
+                    Metrics.METRICS.observe("link_publish_latency_seconds", perf_counter() - enqueued)
+                    Metrics.METRICS.increment("link_publishes_total", kind="tempo")
+                sleep(0.03)
+        self.published = bpm
+        self.last_publish = perf_counter()
+
+    def last_beat_micros(self, link_time: int) -> int:
+        bpm, beat_phase, captured = self.beat
+        return link_time - int((perf_counter() - captured + beat_phase * 60 / bpm) * 1e6)
+
+    def align_beat(self, s: object, link_time: int) -> bool:
+        # maps the nearest whole beat onto the last detected beat;
+        # requestBeatAtTime keeps the phase of the session when peers are
+        # connected, forceBeatAtTime moves every peer
+        if not self.beat_sync or self.beat is None or perf_counter() - self.beat[2] > self.follow_interval + 2:
+            return False
+        last_beat = self.last_beat_micros(link_time)
+        beat = round(s.beatAtTime(last_beat, self.quantum))
+        if self.force_beat:
+            s.forceBeatAtTime(beat, last_beat, self.quantum)
+        else:
+            s.requestBeatAtTime(beat, last_beat, self.quantum)
+        return True
+
+    def align(self, enqueued: float) -> None:
+        s = self.link.captureSessionState()
+        link_time = self.link.clock().micros()
+        phase = s.phaseAtTime(self.last_beat_micros(link_time), 1.0)
+        if min(phase, 1 - phase) > self.phase_tolerance and self.align_beat(s, link_time):
+            self.link.commitSessionState(s)
+            self.publish_latencies.append(perf_counter() - enqueued)
+            self.last_publish = perf_counter()
+            if Metrics.METRICS is not None:
+                Metrics.METRICS.increment("link_publishes_total", kind="beat")
@@ -0,0 +1,194 @@
+import json
+import threading
+from bisect import bisect_left
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+# the registry every instrumented module records into; None while disabled,
+# so a disabled hot path costs one global lookup and comparison
+METRICS = None
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    # Fixed buckets, so recording never allocates and memory never grows.
+    def __init__(self, bounds=SECONDS_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "buckets": dict(zip([*map(str, self.bounds), "+Inf"], self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class Metrics:
+    # Histograms and counters keyed by name and labels, plus gauges that are
+    # only read when the metrics are scraped.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    def describe(self, name: str, help: str) -> None:
+        self.help[name] = help
+
+    def observe(self, name: str, value: float, bounds=SECONDS_BUCKETS, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(bounds))
+        histogram.observe(value)
+
+    def increment(self, name: str, amount=1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name: str, function, **labels) -> None:
+        # function() is called on every scrape
+        self.gauges[(name, tuple(sorted(labels.items())))] = function
+
+    def gauge_values(self) -> dict:
+        values = {}
+        for key, function in list(self.gauges.items()):
+            try:
+                values[key] = float(function())
+            except Exception:
+                pass  # a gauge of a module that is gone
+        return values
+
+    def prometheus(self) -> str:
+        def label_text(labels, extra=()) -> str:
+            labels = [*labels, *extra]
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+        lines = []
+        typed = set()
+
+        def header(name: str, kind: str) -> None:
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        for (name, labels), histogram in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip([*histogram.bounds, "+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{label_text(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{label_text(labels)} {histogram.count}")
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{label_text(labels)} {value}")
+        for (name, labels), value in sorted(self.gauge_values().items()):
+            header(name, "gauge")
+            lines.append(f"{name}{label_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def json(self) -> dict:
+        def entry(name: str, labels: tuple, value) -> dict:
+            return {"name": name, "labels": dict(labels), "value": value}
+
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        return {
+            "histograms": [entry(name, labels, histogram.snapshot()) for (name, labels), histogram in histograms],
+            "counters": [entry(name, labels, value) for (name, labels), value in counters],
+            "gauges": [entry(name, labels, value) for (name, labels), value in sorted(self.gauge_values().items())],
+        }
+
+
+class MetricsServer:
+    # Serves /metrics in the Prometheus text format and /metrics.json from a
+    # daemon thread, on localhost only by default.
+    def __init__(self, metrics: Metrics, port=9464, host="127.0.0.1"):
+        # imported here, so importing the analyzer core stays cheap
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler) -> None:
+                if handler.path == "/metrics":
+                    body, content_type = metrics.prometheus().encode(), "text/plain; version=0.0.4"
+                elif handler.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics.json()).encode(), "application/json"
+                else:
+                    handler.send_error(404)
+                    return
+                handler.send_response(200)
+                handler.send_header("Content-Type", content_type)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *_) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def enable() -> Metrics:
+    global METRICS
+    if METRICS is None:
+        METRICS = Metrics()
+        for name, help in [
+            ("analysis_pass_seconds", "duration of a whole analysis pass"),
+            ("analysis_stage_seconds", "duration of one stage of an analysis pass"),
+            ("analysis_backlog_seconds", "audio that arrived since the previous pass"),
+            ("signal_buffer_fill", "filled share of the analyzer ring buffer at each pass"),
+            ("analysis_passes", "analysis passes since the scheduler started"),
+            ("analysis_late", "analysis passes that overran their hop"),
+            ("analysis_skipped", "hops skipped because a pass overran"),
+            ("analysis_rejected", "analysis passes without a published tempo"),
+            ("analysis_results_total", "accepted analysis passes"),
+            ("analysis_rejections_total", "rejected analysis passes by reason"),
+            ("audio_callback_interval_seconds", "time between two audio callbacks"),
+            ("audio_callback_overruns_total", "audio callbacks that reported an input overflow or came late"),
+            ("link_publishes_total", "tempo and beat commits to the Link session"),
+            ("link_publish_latency_seconds", "time from enqueueing a tempo to committing it to Link"),
+        ]:
+            METRICS.describe(name, help)
+    return METRICS
+
+
+def disable() -> None:
+    global METRICS
+    METRICS = None
@@ -0,0 +1,101 @@
+import os
+import threading
+from collections import deque
+from time import perf_counter, sleep
+
+import numpy as np
+
+TIMING_CLOCK = 0xF8
+START = 0xFA
+STOP = 0xFC
+
+
+class MidiClock:
+    # Sends ppqn timing clock messages per quarter note on a dedicated thread.
+    # Every tick has an absolute deadline on the monotonic perf_counter clock,
+    # so late wake-ups never add up to drift. The thread sleeps until shortly
+    # before a deadline and yields the rest, so the audio callback is never
+    # kept from the GIL. Tempo changes are ramped linearly over ramp_seconds
+    # instead of jumping. Nothing is sent before the first detected tempo.
+    def __init__(self, send, bpm_storage: object, ppqn=24, ramp_seconds=1.0, spin_seconds=0.001, transport=True):
+        self.send = send  # e.g. rtmidi.MidiOut.send_message
+        self.bpm_storage = bpm_storage
+        self.ppqn = ppqn
+        self.ramp_seconds = ramp_seconds
+        self.spin_seconds = spin_seconds
+        self.transport = transport
+        self.stop_clock = threading.Event()
+        self.thread = None
+        self.ramp_start = None
+        self.ramp_from = self.target = bpm_storage._float
+        self.ticks = 0
+        self.lateness = deque(maxlen=4096)  # seconds each tick was sent after its deadline
+
+    def start(self) -> None:
+        self.stop_clock.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_clock.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def set_ramp(self, now: float, bpm: float) -> None:
+        self.ramp_from = self.tempo(now) if self.ramp_start is not None else bpm
+        self.ramp_start = now
+        self.target = bpm
+
+    def tempo(self, now: float) -> float:
+        progress = min((now - self.ramp_start) / self.ramp_seconds, 1.0) if self.ramp_seconds else 1.0
+        return self.ramp_from + (self.target - self.ramp_from) * progress
+
+    def wait_until(self, deadline: float) -> None:
+        remaining = deadline - perf_counter() - self.spin_seconds
+        if remaining > 0:
+            self.stop_clock.wait(remaining)
+        while perf_counter() < deadline:
+            sleep(0)  # hands the GIL over on every turn
+
+    def raise_priority(self) -> None:
+        # real-time scheduling for this thread where the OS allows it, so a
+        # busy analyzer cannot delay a wake-up by a whole time slice
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(os.sched_get_priority_min(os.SCHED_FIFO)))
+        except (AttributeError, OSError):
+            pass
+
+    def run(self) -> None:
+        self.raise_priority()
+        while self.bpm_storage.tempo_tracker.tempo is None:
+            if self.stop_clock.wait(0.05):
+                return
+        self.ramp_start = None
+        next_tick = perf_counter()
+        self.set_ramp(next_tick, self.bpm_storage._float)
+        if self.transport:
+            self.send([START])
+        while not self.stop_clock.is_set():
+            self.wait_until(next_tick)
+            self.send([TIMING_CLOCK])
+            sent = perf_counter()
+            self.lateness.append(sent - next_tick)
+            self.ticks += 1
+            if self.bpm_storage._float != self.target:
+                self.set_ramp(next_tick, self.bpm_storage._float)
+            next_tick += 60 / (self.tempo(next_tick) * self.ppqn)
+            if sent - next_tick > 0.25:
+                next_tick = sent  # stalled for longer than a beat fragment, do not burst to catch up
+        if self.transport:
+            self.send([STOP])
+
+    def jitter_stats(self) -> dict:
+        lateness = np.array(self.lateness) * 1000
+        if not lateness.size:
+            return {"ticks": self.ticks}
+        return {
+            "ticks": self.ticks,
+            "median_ms": float(np.median(lateness)),
+            "p99_ms": float(np.percentile(lateness, 99)),
+            "max_ms": float(lateness.max()),
+        }
@@ -0,0 +1,165 @@
+import argparse
+import functools
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, sleep
+
+import numpy as np
+
+import AnalyzerCore
+from AnalyzerCore import BANDPASS_FILTER, FRAME_RATE, BpmAnalyzer, BpmResult, BpmStorage, RingBuffer, tempo_engine
+
+
+def analyze_buffer(buffer: np.ndarray) -> BpmResult:
+    return tempo_engine().search_bpm(BANDPASS_FILTER.process(buffer), FRAME_RATE)
+
+
+def warm_up() -> None:
+    analyze_buffer(np.zeros(FRAME_RATE, dtype=np.int16))
+
+
+class Channel:
+    def __init__(self, index: int, frame_rate: int, operating_range_seconds=12):
+        self.index = index
+        self.signal_buffer = RingBuffer(int(frame_rate * operating_range_seconds))
+        self.bpm_storage = BpmStorage()
+        self.analyzed = 0  # ring buffer position of the last window sent to a worker
+        self.busy = False
+        self.latencies = deque(maxlen=100)
+        self.subscribers = []
+
+
+class MultiChannelStreamer:
+    # One PortAudio stream per (device, channel count) input. Interleaved
+    # frames are split into one ring buffer per channel.
+    def __init__(self, frame_rate: int, inputs: list[tuple], operating_range_seconds=12):
+        self.frame_rate = frame_rate
+        self.inputs = inputs
+        self.chunk = 10240
+        self.channels = [
+            Channel(index, frame_rate, operating_range_seconds)
+            for index in range(sum(channel_count for _, channel_count in inputs))
+        ]
+        self.buffer_updated = threading.Event()
+        self.streams = []
+
+    def audio_callback(self, channels: list[Channel], continue_flag: int):
+        def callback(in_data: bytes, frame_count, time_info, status) -> tuple:
+            frames = np.frombuffer(in_data, dtype="<i2").reshape(-1, len(channels))
+            for column, channel in enumerate(channels):
+                channel.signal_buffer.write(frames[:, column])
+            self.buffer_updated.set()
+            return (None, continue_flag)
+
+        return callback
+
+    def start_streams(self) -> None:
+        import pyaudio
+
+        self.audio = pyaudio.PyAudio()
+        first = 0
+        for device_index, channel_count in self.inputs:
+            stream = self.audio.open(
+                format=pyaudio.paInt16,
+                channels=channel_count,
+                rate=self.frame_rate,
+                input=True,
+                frames_per_buffer=self.chunk,
+                input_device_index=device_index,
+                stream_callback=self.audio_callback(
+                    self.channels[first : first + channel_count], pyaudio.paContinue
+                ),
+                start=False,
+            )
+            stream.start_stream()
+            self.streams.append(stream)
+            first += channel_count
+
+    def stop_streams(self) -> None:
+        for stream in self.streams:
+            stream.stop_stream()
+            stream.close()
+        self.audio.terminate()
+
+
+class MultiChannelAnalyzer:
+    # Analyzes every channel in a process pool, so the pure Python parts of
+    # search_bpm do not serialize on the GIL. A channel has at most one window
+    # in flight; while it is busy newer audio simply replaces the next window.
+    def __init__(self, channels: list[Channel], buffer_updated: threading.Event, workers=None):
+        self.channels = channels
+        self.buffer_updated = buffer_updated
+        AnalyzerCore.shared_pattern_cache()
+        # workers start lazily, after PortAudio has started its threads, so
+        # they must not be forked from this process
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers or min(len(channels), os.cpu_count()),
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=warm_up,
+        )
+        self.stop_analyzer = threading.Event()
+
+    def run(self) -> None:
+        while not self.stop_analyzer.is_set():
+            self.buffer_updated.wait(0.5)
+            self.buffer_updated.clear()
+            self.schedule()
+
+    def schedule(self) -> None:
+        for channel in self.channels:
+            if channel.busy or channel.signal_buffer.written == channel.analyzed:
+                continue
+            channel.busy = True
+            channel.analyzed = channel.signal_buffer.written
+            future = self.executor.submit(analyze_buffer, channel.signal_buffer.read())
+            future.add_done_callback(functools.partial(self.publish, channel, perf_counter()))
+
+    def publish(self, channel: Channel, submitted: float, future) -> None:
+        channel.latencies.append(perf_counter() - submitted)
+        if not future.cancelled() and future.exception() is None and (result := future.result()):
+            BpmAnalyzer.store_bpm(channel.bpm_storage, result.bpm, result.confidence)
+            for subscriber in channel.subscribers:
+                subscriber(channel.index, channel.bpm_storage._float)
+        channel.busy = False
+        self.buffer_updated.set()
+
+    def stop(self) -> None:
+        self.stop_analyzer.set()
+        self.executor.shutdown(cancel_futures=True)
+
+
+def parse_input(value: str) -> tuple:
+    device_index, _, channel_count = value.partition(":")
+    return int(device_index), int(channel_count or 1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Analyze the tempo of several audio inputs at once")
+    parser.add_argument(
+        "-i", "--input", type=parse_input, action="append", required=True,
+        help="DEVICE_INDEX[:CHANNELS], repeat for more devices",
+    )
+    parser.add_argument("-w", "--workers", type=int)
+    args = parser.parse_args()
+
+    streamer = MultiChannelStreamer(FRAME_RATE, args.input)
+    analyzer = MultiChannelAnalyzer(streamer.channels, streamer.buffer_updated, args.workers)
+    streamer.start_streams()
+    threading.Thread(target=analyzer.run, daemon=True).start()
+    try:
+        while True:
+            sleep(1)
+            print("  ".join(f"{channel.index}: {channel.bpm_storage._str}" for channel in streamer.channels))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        analyzer.stop()
+        streamer.stop_streams()
+
+
+if __name__ == "__main__":
+    main()
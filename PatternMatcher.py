@@ -0,0 +1,67 @@
+import numpy as np
+
+import ExtractBpmPatterns
+
+
+class PatternMatcher:
+    # Flat sorted index over all pattern timestamps. Every entry keeps the
+    # (tempo, offset) cell it came from, so a beat event becomes a
+    # searchsorted range lookup instead of a scan over the whole pattern.
+    def __init__(self, bpm_pattern: np.ndarray, index=None):
+        self.steps, self.offsets, self.beats = bpm_pattern.shape
+        if index is None:
+            index = PatternMatcher.sorted_index(bpm_pattern)
+        self.timestamps, self.flat_index = index
+
+    def sorted_index(bpm_pattern: np.ndarray, chunk_cells=1 << 18) -> np.ndarray:
+        # timestamps with their cells, sorted by timestamp and then by cell: a
+        # counting sort over a few rows at a time, so a BpmPattern is never
+        # expanded whole and no full-size int64 temporaries are made
+        rows, offsets, beats = bpm_pattern.shape
+        chunk_rows = max(chunk_cells // (offsets * beats), 1)
+        chunks = [slice(start, min(start + chunk_rows, rows)) for start in range(0, rows, chunk_rows)]
+        if len(chunks) <= 4:
+            # small enough to sort whole, e.g. a fine window
+            return PatternMatcher.sorted_chunk(np.asarray(bpm_pattern[:]).ravel())
+        highest = max(int(bpm_pattern[chunk].max()) for chunk in chunks)
+        next_free = np.zeros(highest + 1, dtype=np.int64)  # where the next entry of each timestamp goes
+        for chunk in chunks:
+            next_free += np.bincount(bpm_pattern[chunk].ravel(), minlength=highest + 1)
+        next_free = np.cumsum(next_free) - next_free
+        index = np.empty((2, rows * offsets * beats), dtype=np.int32)
+        cell = 0
+        for chunk in chunks:
+            timestamps, order = PatternMatcher.sorted_chunk(np.asarray(bpm_pattern[chunk]).ravel())
+            # every run of equal timestamps goes after the entries of earlier chunks
+            runs = np.flatnonzero(np.diff(timestamps, prepend=-1))
+            lengths = np.diff(runs, append=timestamps.size)
+            values = timestamps[runs]
+            positions = np.arange(timestamps.size) + np.repeat(next_free[values] - runs, lengths)
+            index[0, positions] = timestamps
+            index[1, positions] = order + cell
+            next_free[values] += lengths
+            cell += timestamps.size
+        return index
+
+    def sorted_chunk(timestamps: np.ndarray) -> np.ndarray:
+        # timestamp and cell packed into one int64 key: a plain sort is a
+        # stable argsort and hands back both columns
+        bits = max(int(timestamps.size - 1).bit_length(), 1)
+        keys = np.sort((timestamps.astype(np.int64) << bits) | np.arange(timestamps.size))
+        return np.stack(((keys >> bits).astype(np.int32), (keys & ((1 << bits) - 1)).astype(np.int32)))
+
+    def cached(bpm_pattern: ExtractBpmPatterns.BpmPattern, name: str, directory=".") -> "PatternMatcher":
+        index = ExtractBpmPatterns.load_cached(
+            name, bpm_pattern.parameters, lambda: PatternMatcher.sorted_index(bpm_pattern), directory
+        )
+        return PatternMatcher(bpm_pattern, index)
+
+    def match(self, beat_events: np.ndarray, tolerance=20) -> tuple:
+        lower = np.searchsorted(self.timestamps, beat_events - tolerance, side="left")
+        upper = np.searchsorted(self.timestamps, beat_events + tolerance, side="right")
+        counts = upper - lower
+        events = np.repeat(np.arange(beat_events.size), counts)
+        positions = np.arange(counts.sum()) + np.repeat(lower - np.cumsum(counts) + counts, counts)
+        cells = self.flat_index[positions]
+        tempos, offsets = np.divmod(cells // self.beats, self.offsets)
+        return events, tempos, offsets
@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import struct
+import sys
+import threading
+import types
+from math import gcd
+from time import perf_counter, sleep
+
+import numpy as np
+
+# a WAV file with a "bpmr" chunk before the data that counts the samples
+# written so far; once the data chunk is full the recorder wraps around, and
+# the count says where the oldest sample is
+HEADER = struct.Struct("<4sI4s4sIHHIIHH4sIQ4sI")
+HEADER_SIZE = HEADER.size
+
+
+class Recorder:
+    # Streams int16 mono audio into a preallocated, memory-mapped WAV file
+    # that never grows beyond max_seconds of audio. When it is full the oldest
+    # audio is overwritten; close() puts the samples back in order and fixes
+    # the header, and read_recording() does the same for a file that was
+    # never closed.
+    def __init__(self, path: str, frame_rate: int, max_seconds=3600):
+        self.path = path
+        self.frame_rate = frame_rate
+        self.capacity = int(frame_rate * max_seconds)
+        with open(path, "wb") as recording:
+            recording.write(self.header(self.capacity, 0))
+            recording.truncate(HEADER_SIZE + 2 * self.capacity)
+        self.map = np.memmap(path, dtype=np.uint8, mode="r+")
+        self.samples = self.map[HEADER_SIZE:].view("<i2")
+        self.written_field = self.map[HEADER_SIZE - 16 : HEADER_SIZE - 8].view("<u8")
+        self.written = 0
+
+    def header(self, samples: int, written: int) -> bytes:
+        riff = (b"RIFF", HEADER_SIZE - 8 + 2 * samples, b"WAVE")
+        fmt = (b"fmt ", 16, 1, 1, self.frame_rate, 2 * self.frame_rate, 2, 16)  # PCM, mono, 16 bit
+        return HEADER.pack(*riff, *fmt, b"bpmr", 8, written, b"data", 2 * samples)
+
+    def write(self, samples: np.ndarray) -> None:
+        # called from the audio callback: one or two copies into the page cache
+        if samples.size > self.capacity:
+            self.written += samples.size - self.capacity
+            samples = samples[-self.capacity :]
+        start = self.written % self.capacity
+        first = min(samples.size, self.capacity - start)
+        self.samples[start : start + first] = samples[:first]
+        self.samples[: samples.size - first] = samples[first:]
+        self.written += samples.size
+        self.written_field[0] = self.written
+
+    def close(self) -> None:
+        if self.written > self.capacity:
+            self.samples[:] = np.roll(self.samples, -(self.written % self.capacity))
+        samples = min(self.written, self.capacity)
+        self.map[:HEADER_SIZE] = np.frombuffer(self.header(samples, samples), dtype=np.uint8)
+        self.map.flush()
+        del self.samples, self.written_field, self.map
+        with open(self.path, "r+b") as recording:
+            recording.truncate(HEADER_SIZE + 2 * samples)
+
+
+def read_recording(path: str, frame_rate: int) -> np.ndarray:
+    # the samples of a recording, or of any PCM WAV file, as int16 mono at
+    # frame_rate; a file of the recorder at frame_rate is memory-mapped
+    with open(path, "rb") as recording:
+        riff, _, wave = struct.unpack("<4sI4s", recording.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise ValueError(f"{path} is not a WAV file")
+        fmt, written = None, None
+        while chunk := recording.read(8):
+            chunk_id, size = struct.unpack("<4sI", chunk)
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", recording.read(16))
+                recording.seek(size - 16 + size % 2, os.SEEK_CUR)
+            elif chunk_id == b"bpmr":
+                (written,) = struct.unpack("<Q", recording.read(8))
+            elif chunk_id == b"data":
+                offset = recording.tell()
+                break
+            else:
+                recording.seek(size + size % 2, os.SEEK_CUR)
+        else:
+            raise ValueError(f"{path} has no data chunk")
+    if fmt is None or fmt[0] != 1 or fmt[5] != 16:
+        raise ValueError(f"{path} is not 16 bit PCM")
+    _, channels, source_rate, _, _, _ = fmt
+    size = min(size, os.path.getsize(path) - offset) // (2 * channels) * 2 * channels
+    samples = np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=(size // 2,))
+    if written is not None and written > samples.size:
+        # never closed after wrapping around
+        samples = np.roll(samples, -(written % samples.size))
+    elif written is not None:
+        samples = samples[:written]
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    if source_rate != frame_rate:
+        common = gcd(frame_rate, source_rate)
+        samples = np.clip(
+            np.round(resample(samples, frame_rate // common, source_rate // common)), -32768, 32767
+        ).astype(np.int16)
+    return samples
+
+
+def resample(samples: np.ndarray, up: int, down: int) -> np.ndarray:
+    from scipy import signal
+
+    return signal.resample_poly(samples.astype(np.float32), up, down)
+
+
+class ReplayStreamer:
+    # Stands in for AudioStreamer and feeds a recording into the same ring
+    # buffer the analyzer reads. speed 1.0 is real time; None feeds as fast as
+    # the analyzer keeps up: one hop of audio per analysis pass, so every run
+    # over the same file gives the same passes.
+    def __init__(self, path: str, frame_rate: int, speed=1.0, chunk=10240, operating_range_seconds=12):
+        from AnalyzerCore import RingBuffer
+
+        self.path = path
+        self.frame_rate = frame_rate
+        self.speed = speed
+        self.chunk = chunk
+        self.samples = read_recording(path, frame_rate)
+        self.signal_buffer = RingBuffer(int(frame_rate * operating_range_seconds))
+        self.buffer_updated = threading.Event()
+        self.finished = threading.Event()
+        self.stop_replay = threading.Event()
+        self.analysis_scheduler = None  # set to run in lockstep with it when speed is None
+        self.lockstep = False
+        self.thread = None
+
+    def start_stream(self, input_device_index=None) -> None:
+        self.stop_replay.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop_stream(self) -> None:
+        self.stop_replay.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def available_audio_devices(self) -> list:
+        return [[f"Replay: {os.path.basename(self.path)}"], [0]]
+
+    def wait_for_pass(self, passes: int) -> None:
+        while self.analysis_scheduler.passes <= passes and not self.stop_replay.is_set():
+            sleep(0.0002)
+
+    def feed(self, block: np.ndarray) -> None:
+        passes = self.analysis_scheduler.passes if self.lockstep else None
+        self.signal_buffer.write(np.asarray(block))
+        self.buffer_updated.set()
+        if self.lockstep:
+            self.wait_for_pass(passes)
+
+    def run(self) -> None:
+        self.lockstep = self.speed is None and self.analysis_scheduler is not None
+        position = 0
+        if self.lockstep:
+            # the whole operating range at once, as a running stream would have
+            position = min(self.signal_buffer.size, self.samples.size)
+            self.feed(self.samples[:position])
+        deadline = perf_counter()
+        while position < self.samples.size and not self.stop_replay.is_set():
+            block = self.samples[position : position + self.chunk]
+            position += block.size
+            if self.speed is not None:
+                deadline += block.size / self.frame_rate / self.speed
+                self.stop_replay.wait(max(deadline - perf_counter(), 0))
+            self.feed(block)
+        self.finished.set()
+
+
+def replay(path: str, speed=None, engine=None, hop_seconds=None) -> dict:
+    # runs a recording through BpmAnalyzer.run_analyzer and returns the
+    # tempo timeline with the scheduler statistics
+    from AnalyzerCore import ANALYSIS_HOP_SECONDS, FRAME_RATE, AnalysisScheduler, BpmAnalyzer, BpmStorage
+
+    hop_seconds = ANALYSIS_HOP_SECONDS if hop_seconds is None else hop_seconds
+    # in lockstep one hop of audio is fed per pass, the replay paces the passes
+    chunk = int(hop_seconds * FRAME_RATE) if speed is None else 10240
+    streamer = ReplayStreamer(path, FRAME_RATE, speed, chunk)
+    scheduler = AnalysisScheduler(
+        streamer.signal_buffer,
+        streamer.buffer_updated,
+        BpmStorage(),
+        hop_seconds=0 if speed is None else hop_seconds,
+        engine=engine,
+    )
+    streamer.analysis_scheduler = scheduler
+    timeline = []
+    scheduler.subscribe(
+        lambda bpm_float, bpm_str: timeline.append((round(scheduler.analyzed / FRAME_RATE, 3), bpm_float))
+    )
+    modules = types.SimpleNamespace(
+        analysis_scheduler=scheduler, threading_events=types.SimpleNamespace(stop_analyzer=threading.Event())
+    )
+    analyzer = threading.Thread(target=BpmAnalyzer.run_analyzer, args=(modules,), daemon=True)
+    start = perf_counter()
+    analyzer.start()
+    streamer.start_stream()
+    streamer.finished.wait()
+    if speed is not None:
+        sleep(min(hop_seconds, 1.0) + 0.1)  # the last pass over the tail
+    modules.threading_events.stop_analyzer.set()
+    streamer.buffer_updated.set()
+    analyzer.join()
+    seconds = perf_counter() - start
+    audio_seconds = streamer.samples.size / FRAME_RATE
+    return {
+        "path": path,
+        "audio_seconds": round(audio_seconds, 3),
+        "wall_seconds": round(seconds, 3),
+        "speed": round(audio_seconds / seconds, 2),
+        "passes": scheduler.passes,
+        "rejected": scheduler.rejected,
+        "late": scheduler.late,
+        "skipped": scheduler.skipped,
+        "pass_ms_median": round(float(np.median(scheduler.pass_seconds)) * 1000, 3) if scheduler.pass_seconds else None,
+        "bpm": scheduler.bpm_storage._str,
+        "timeline": timeline,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="bpm-replay", description="Run a recording through the live analyzer")
+    parser.add_argument("path", help="a recording of the analyzer or any 16 bit PCM WAV file")
+    parser.add_argument("--speed", type=float, default=None, help="1.0 for real time; as fast as possible if omitted")
+    parser.add_argument("--engine", help="tempo engine, defaults to TEMPO_ENGINE in AnalyzerCore.py")
+    parser.add_argument("--hop", type=float, help="seconds of audio between passes")
+    parser.add_argument("--json", help="write the result to this file")
+    args = parser.parse_args()
+
+    result = replay(args.path, args.speed, args.engine, args.hop)
+    for seconds, bpm in result["timeline"]:
+        print(f"{seconds:9.2f} s  {bpm:7.2f}")
+    print(
+        f"{result['audio_seconds']:.1f} s of audio in {result['wall_seconds']:.1f} s ({result['speed']:.1f}x), "
+        f"{result['passes']} passes, {result['rejected']} rejected, {result['late']} late, "
+        f"median pass {result['pass_ms_median']} ms, final {result['bpm']} BPM",
+        file=sys.stderr,
+    )
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(result, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import asyncio
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+import time
+from time import perf_counter
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def osc_string(value: str) -> bytes:
+    data = value.encode() + b"\0"
+    return data + b"\0" * (-len(data) % 4)
+
+
+def osc_message(address: str, *arguments) -> bytes:
+    tags = "," + "".join("i" if isinstance(argument, int) else "f" for argument in arguments)
+    packed = b"".join(
+        struct.pack(">i", argument) if isinstance(argument, int) else struct.pack(">f", argument)
+        for argument in arguments
+    )
+    return osc_string(address) + osc_string(tags) + packed
+
+
+def parse_osc_address(data: bytes) -> str:
+    return data[: data.find(b"\0")].decode(errors="replace")
+
+
+def websocket_frame(payload: bytes, opcode=0x1) -> bytes:
+    # a single unmasked frame, as a server sends them
+    if len(payload) < 126:
+        header = struct.pack(">BB", 0x80 | opcode, len(payload))
+    elif len(payload) < 65536:
+        header = struct.pack(">BBH", 0x80 | opcode, 126, len(payload))
+    else:
+        header = struct.pack(">BBQ", 0x80 | opcode, 127, len(payload))
+    return header + payload
+
+
+async def read_websocket_frame(reader: asyncio.StreamReader, from_client=False) -> tuple:
+    # frames from a client must be masked; subscribers only send control
+    # frames, so anything longer than one is refused before it is buffered
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if from_client and (length > 125 or not second & 0x80):
+        raise ValueError("unexpected frame from a subscriber")
+    if length == 126:
+        (length,) = struct.unpack(">H", await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack(">Q", await reader.readexactly(8))
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    return first & 0x0F, payload
+
+
+class Client:
+    # The newest message of every kind waiting for one subscriber. A client
+    # that falls behind skips to the newest tempo and beat instead of
+    # queueing, so memory per client stays constant.
+    def __init__(self, send, name: str):
+        self.send = send  # coroutine function taking the message dict
+        self.name = name
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.coalesced = 0
+        self.task = None
+
+    def offer(self, kind: str, message: dict) -> None:
+        self.coalesced += kind in self.pending
+        self.pending[kind] = message
+        self.ready.set()
+
+    async def run(self) -> None:
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            pending, self.pending = self.pending, {}
+            for message in pending.values():
+                await self.send(message)
+
+
+class TempoServer:
+    # Broadcasts the tempo, its confidence and a tick on every beat to OSC
+    # (UDP) and WebSocket subscribers from an asyncio loop on its own thread.
+    # The analyzer only hands over values. OSC clients subscribe by sending
+    # /bpm/subscribe (optionally with the port to send to) to osc_port, or are
+    # listed in osc_targets. A WebSocket client that cannot take a message
+    # within slow_client_seconds is disconnected. Subscribers are not
+    # authenticated, so only localhost is served unless host says otherwise.
+    def __init__(
+        self,
+        osc_port=None,
+        websocket_port=None,
+        osc_targets=(),
+        host="127.0.0.1",
+        slow_client_seconds=2.0,
+        max_clients=1024,
+    ):
+        self.osc_port = osc_port
+        self.websocket_port = websocket_port
+        self.osc_targets = list(osc_targets)
+        self.host = host
+        self.slow_client_seconds = slow_client_seconds
+        self.max_clients = max_clients
+        self.clients = set()
+        self.osc_clients = {}  # by address
+        self.disconnected = 0  # WebSocket clients dropped for being too slow
+        self.osc_transport = self.websocket_server = None
+        self.beat = None  # (bpm, perf_counter time of a beat)
+        self.confidence = None  # of the latest pass
+        self.tempo = None
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self) -> None:
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        except OSError as error:
+            self.error = error  # e.g. the port is taken
+        self.started.set()
+        if self.error is None:
+            self.loop.run_forever()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        if self.osc_transport is not None:
+            self.osc_transport.close()
+        if self.websocket_server is not None:
+            self.websocket_server.close()
+        self.loop.close()
+
+    async def serve(self) -> None:
+        if self.osc_port is not None or self.osc_targets:
+            self.osc_transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: OscProtocol(self), local_addr=(self.host, self.osc_port or 0)
+            )
+            self.osc_port = self.osc_transport.get_extra_info("sockname")[1]
+            for target in self.osc_targets:
+                self.add_osc_client(tuple(target))
+        if self.websocket_port is not None:
+            self.websocket_server = await asyncio.start_server(
+                self.websocket_client, self.host, self.websocket_port, backlog=self.max_clients
+            )
+            self.websocket_port = self.websocket_server.sockets[0].getsockname()[1]
+        self.loop.create_task(self.tick())
+
+    # called from other threads
+
+    def call_soon(self, callback, *arguments) -> None:
+        # the analyzer thread may still publish a last result after stop()
+        try:
+            self.loop.call_soon_threadsafe(callback, *arguments)
+        except RuntimeError:
+            pass  # the loop is closed
+
+    def publish_tempo(self, bpm_float: float, bpm_str: str) -> None:
+        # fits AnalysisScheduler.subscribe
+        self.call_soon(self.broadcast_tempo, bpm_float, time.time())
+
+    def publish_result(self, result: object, captured: float) -> None:
+        # fits AnalysisScheduler.subscribe_result; result subscribers run
+        # before the tempo is published, so the confidence goes with it
+        if result:
+            self.call_soon(setattr, self, "confidence", result.confidence)
+
+    def publish_beat(self, bpm_float: float, beat_phase: float, captured: float) -> None:
+        # fits AnalysisScheduler.subscribe_beat
+        if beat_phase is not None:
+            self.call_soon(setattr, self, "beat", (bpm_float, captured - beat_phase * 60 / bpm_float))
+
+    # on the loop
+
+    def broadcast(self, kind: str, message: dict) -> None:
+        for client in self.clients:
+            client.offer(kind, message)
+
+    def broadcast_tempo(self, bpm: float, sent: float) -> None:
+        self.tempo = {"type": "tempo", "bpm": bpm, "confidence": self.confidence, "time": sent}
+        self.broadcast("tempo", self.tempo)
+
+    async def tick(self) -> None:
+        # one beat message per beat of the latest detected beat grid; a grid
+        # that moved never produces two ticks within half a beat
+        number, last_tick = 0, float("-inf")
+        while True:
+            if self.beat is None:
+                await asyncio.sleep(0.05)
+                continue
+            bpm, last_beat = self.beat
+            period = 60 / bpm
+            now = perf_counter()
+            next_beat = last_beat + (int((now - last_beat) / period) + 1) * period
+            if next_beat - last_tick < period / 2:
+                next_beat += period
+            await asyncio.sleep(next_beat - now)
+            number, last_tick = number + 1, next_beat
+            self.broadcast("beat", {"type": "beat", "beat": number, "bpm": bpm, "time": time.time()})
+
+    def add_client(self, client: Client) -> bool:
+        if len(self.clients) >= self.max_clients:
+            return False
+        self.clients.add(client)
+        if self.tempo is not None:
+            client.offer("tempo", self.tempo)
+        return True
+
+    def add_osc_client(self, address: tuple) -> None:
+        if address in self.osc_clients:
+            return
+
+        async def send(message: dict) -> None:
+            if message["type"] == "tempo":
+                data = osc_message("/bpm/tempo", float(message["bpm"]), float(message["confidence"] or 0.0))
+            else:
+                data = osc_message("/bpm/beat", message["beat"], float(message["bpm"]))
+            self.osc_transport.sendto(data, address)
+
+        client = Client(send, address)
+        if self.add_client(client):
+            self.osc_clients[address] = client
+            client.task = self.loop.create_task(client.run())
+
+    def remove_osc_client(self, address: tuple) -> None:
+        client = self.osc_clients.pop(address, None)
+        if client is not None:
+            client.task.cancel()
+            self.clients.discard(client)
+
+    async def websocket_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        slow = False
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            headers = {}
+            for line in request.decode(errors="replace").split("\r\n")[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            key = headers.get("sec-websocket-key")
+            if headers.get("upgrade", "").lower() != "websocket" or not key:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+                await writer.drain()
+                return
+            accept = base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+            writer.write(
+                "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+            )
+
+            # small buffers, so a stalled client is noticed after a few hundred
+            # messages instead of the megabytes the kernel would queue for it
+            writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+            writer.transport.set_write_buffer_limits(high=16384)
+
+            def drop_slow() -> None:
+                # drops what the client did not take, the pending drain fails
+                nonlocal slow
+                slow = True
+                writer.transport.abort()
+
+            async def send(message: dict) -> None:
+                writer.write(websocket_frame(json.dumps(message).encode()))
+                timeout = self.loop.call_later(self.slow_client_seconds, drop_slow)
+                try:
+                    await writer.drain()
+                finally:
+                    timeout.cancel()
+
+            client = Client(send, writer.get_extra_info("peername"))
+            if not self.add_client(client):
+                writer.write(websocket_frame(struct.pack(">H", 1013), opcode=0x8))  # try again later
+                await writer.drain()
+                return
+            sender = self.loop.create_task(client.run())
+            receiver = self.loop.create_task(self.websocket_receive(reader, writer))
+            try:
+                await asyncio.wait([sender, receiver], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                self.clients.discard(client)
+                for task in (sender, receiver):
+                    if task.done() and not task.cancelled():
+                        task.exception()  # a lost connection ends both
+                    task.cancel()
+                self.disconnected += slow
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def websocket_receive(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # subscribers only listen; answers pings and ends on close
+        while True:
+            try:
+                opcode, payload = await read_websocket_frame(reader, from_client=True)
+            except ValueError:
+                writer.write(websocket_frame(struct.pack(">H", 1002), opcode=0x8))  # protocol error
+                return
+            if opcode == 0x8:
+                writer.write(websocket_frame(payload[:2], opcode=0x8))
+                return
+            if opcode == 0x9:
+                writer.write(websocket_frame(payload, opcode=0xA))
+
+
+class OscProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: TempoServer):
+        self.server = server
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        command = parse_osc_address(data)
+        # an optional int argument is the port to send to
+        arguments = data[len(osc_string(command)) :]
+        if arguments.startswith(b",i") and len(arguments) >= 8:
+            address = (address[0], struct.unpack(">i", arguments[4:8])[0])
+        if command == "/bpm/subscribe":
+            self.server.add_osc_client(address)
+        elif command == "/bpm/unsubscribe":
+            self.server.remove_osc_client(address)
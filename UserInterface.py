@@ -1,8 +1,5 @@
-from PyQt5.QtWidgets import QApplication
 import PySimpleGUI as sg
 import sys
-import tkinter as tk
-from time import sleep
 
 sg.theme("Black")
 sg.set_options(dpi_awareness=True)
@@ -33,6 +30,8 @@ class win_lay:
 
 
 def check_screen_resolution() -> int:
+    from PyQt5.QtWidgets import QApplication
+
     app = QApplication(sys.argv)
     screen = app.screens()[0]
     dpi = screen.physicalDotsPerInch()
@@ -43,7 +42,7 @@ def check_screen_resolution() -> int:
         return int(0)
 
 
-def audio_device_selection(audio_devices: list, resolution: int) -> sg.Window:
+def audio_device_selection(audio_devices: list, resolution: int, tempo_engines=(), tempo_engine=None) -> sg.Window:
     layout = [
         [
             sg.Combo(
@@ -69,7 +68,17 @@ def audio_device_selection(audio_devices: list, resolution: int) -> sg.Window:
                 disabled=True,
                 focus=True,
                 pad=(15, 0),
-            )
+            ),
+            sg.Combo(
+                list(tempo_engines),
+                background_color="white",
+                text_color="black",
+                default_value=tempo_engine,
+                key="engine",
+                enable_events=True,
+                readonly=True,
+                visible=bool(tempo_engines),
+            ),
         ],
     ]
 
@@ -289,27 +298,15 @@ def main_window(resolution: int) -> sg.Window:
     )
 
 
-def update_link_button(main_window: object, modules: object) -> None:
-    isOn = 0
+def update_link_button(main_window: object, peers: int) -> None:
+    # called by AbletonLink whenever a peer joins or leaves
     button_info = {
         0: ("LINK", "white on blue"),
         1: ("1 LINK", "white on blue"),
         2: ("2 LINKS", "white on blue"),
         3: ("3 LINKS", "white on blue"),
     }
-    while True:
-        if main_window == sg.WIN_CLOSED:
-            break
-        if modules.ableton_link.link.enabled == False:
-            break
-        peers = (
-            modules.ableton_link.num_peers()
-            if modules.ableton_link.link.enabled == True
-            else peers
+    if peers in button_info:
+        main_window.Element("link").Update(
+            button_info[peers][0], button_color=button_info[peers][1]
         )
-        if peers in button_info and peers != isOn:
-            main_window.Element("link").Update(
-                button_info[peers][0], button_color=button_info[peers][1]
-            )
-            isOn = peers
-        sleep(0.04)